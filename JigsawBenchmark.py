@@ -0,0 +1,424 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+""" Headless benchmarks for the piece cutting engine.
+
+Run from the activity directory, no display needed:
+
+    python3 JigsawBenchmark.py cutter -o run.json
+    python3 JigsawBenchmark.py cutter -o new.json --baseline run.json
+    python3 JigsawBenchmark.py pick -n 1000
+    python3 JigsawBenchmark.py layout -n 1000
+    python3 JigsawBenchmark.py shuffle -o after.json
+
+Results are written as JSON. When a baseline is given, every matching
+(cutter, grid, image) entry is compared and the run fails if the time per
+piece grew more than the allowed tolerance.
+
+The cutter benchmark only knows the current cutting engine. The shuffle one
+times whole shuffles of any checkout instead, each in a new interpreter, so
+older versions can be measured too, from a git worktree:
+
+    git worktree add /tmp/jigsaw-before <commit>
+    python3 JigsawBenchmark.py shuffle --tree /tmp/jigsaw-before -o before.json
+    python3 JigsawBenchmark.py shuffle -o after.json --baseline before.json
+
+It also takes the peak RSS of every shuffle, and how long dropping its pieces
+takes, with the pieces cut one by one or into an atlas:
+
+    python3 JigsawBenchmark.py shuffle -o pieces.json
+    python3 JigsawBenchmark.py shuffle --atlas -o atlas.json --baseline pieces.json
+"""
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gdk, GdkPixbuf
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import cairo
+
+import JigsawPuzzleWidget
+from JigsawPuzzleWidget import CutBoard, CUTTERS
+from JigsawPickIndex import PickIndex, PieceMask
+from JigsawLayout import scatter
+
+GRIDS = (3, 5, 8, 16, 32)
+IMAGE_SIZES = ((320, 240), (640, 480), (1024, 768))
+# The pieces per line of the easy, medium and hard levels
+LEVEL_GRIDS = (3, 5, 8)
+
+# Run by bench_shuffle in a new interpreter, with the tree, grid, width, height, cutter,
+# workers and atlas as arguments. It only uses what every version of CutBoard has: older
+# ones cut every piece in _prepare, newer ones as iter_pieces is consumed.
+# ru_maxrss is in KiB, except on macOS where it is in bytes.
+SHUFFLE_SCRIPT = """
+import sys, gc, json, time, resource, platform
+sys.path.insert(0, sys.argv[1])
+from gi.repository import GdkPixbuf
+import JigsawPuzzleWidget
+grid, width, height = int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+cutter, workers, atlas = sys.argv[5], int(sys.argv[6]), sys.argv[7] == '1'
+if hasattr(JigsawPuzzleWidget, 'CUT_WORKERS'):
+    JigsawPuzzleWidget.CUT_WORKERS = workers
+if hasattr(JigsawPuzzleWidget, 'CUT_ATLAS'):
+    JigsawPuzzleWidget.CUT_ATLAS = atlas
+elif atlas:
+    sys.exit("This tree has no atlas mode")
+def rss ():
+    unit = platform.system() == 'Darwin' and 1 or 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+pb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, width, height)
+pb.fill(0x3366CCFF)
+cb = JigsawPuzzleWidget.CutBoard()
+cb.pb = pb
+rss_start = rss()
+t = time.perf_counter()
+cb._prepare(grid, grid, cutter)
+if hasattr(cb, 'iter_pieces'):
+    pieces = list(cb.iter_pieces())
+else:
+    pieces = [p for col in cb.pieces for p in col]
+hint = cb.get_hint()
+elapsed = time.perf_counter() - t
+rss_peak = rss()
+count = len(pieces)
+t = time.perf_counter()
+del pieces, hint, cb
+gc.collect()
+teardown = time.perf_counter() - t
+print(json.dumps({'pieces': count, 'time': elapsed, 'teardown': teardown,
+                  'rss_start_bytes': rss_start, 'rss_peak_bytes': rss_peak}))
+"""
+
+def make_pixbuf (width, height):
+    """ A synthetic board image, so runs do not depend on the bundled pictures. """
+    pb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, width, height)
+    pb.fill(0x3366CCFF)
+    return pb
+
+def surface_bytes (surface):
+    return surface.get_stride() * surface.get_height()
+
+def pixbuf_bytes (pb):
+    return pb.get_rowstride() * pb.get_height()
+
+def bench_cut (cutter, grid, width, height, repeat=3):
+    """ Times CutBoard._prepare and every step of CutBoard.cut for one configuration,
+    on the calling thread. Times are the best of repeat runs, in seconds.
+    Tracing Python allocations slows the Python code much more than cairo, so the peak
+    Python memory is taken in a pass of its own, after the timed ones. """
+    best = None
+    for n in range(repeat):
+        cb = CutBoard()
+        cb.pb = make_pixbuf(width, height)
+        t = time.perf_counter()
+        cb._prepare(grid, grid, cutter)
+        prepare = time.perf_counter() - t
+        path_t = mask_t = images_t = pixbuf_t = 0.0
+        allocated = surface_bytes(cb.pm)
+        for c in range(cb.cols):
+            for r in range(cb.rows):
+                crop_x, crop_y, fw, fh = cb.piece_rect(c, r)[:4]
+                t = time.perf_counter()
+                path = cb.piece_path(c, r)
+                t1 = time.perf_counter()
+                mask = cairo.ImageSurface(cairo.FORMAT_A1, fw, fh)
+                cb.render_mask(c, r, path, mask)
+                t2 = time.perf_counter()
+                piece_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, fw, fh)
+                outlined_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, fw, fh)
+                cb.render_images(c, r, path, mask, piece_surface, outlined_surface)
+                t3 = time.perf_counter()
+                pb = Gdk.pixbuf_get_from_surface(piece_surface, 0, 0, fw, fh)
+                pb_wf = Gdk.pixbuf_get_from_surface(outlined_surface, 0, 0, fw, fh)
+                t4 = time.perf_counter()
+                path_t += t1 - t
+                mask_t += t2 - t1
+                images_t += t3 - t2
+                pixbuf_t += t4 - t3
+                allocated += surface_bytes(mask) + surface_bytes(piece_surface) + \
+                    surface_bytes(outlined_surface) + pixbuf_bytes(pb) + pixbuf_bytes(pb_wf)
+        pieces = cb.cols * cb.rows
+        run = {'pieces': pieces,
+               'prepare': prepare,
+               'path': path_t / pieces,
+               'mask': mask_t / pieces,
+               'images': images_t / pieces,
+               'pixbuf': pixbuf_t / pieces,
+               'per_piece': (path_t + mask_t + images_t + pixbuf_t) / pieces,
+               'allocated_bytes': allocated,
+               }
+        if best is None or run['per_piece'] < best['per_piece']:
+            best = run
+    cb = CutBoard()
+    cb.pb = make_pixbuf(width, height)
+    tracemalloc.start()
+    cb._prepare(grid, grid, cutter)
+    for c in range(cb.cols):
+        for r in range(cb.rows):
+            cb.cut(c, r)
+    best['python_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best
+
+def bench_pipeline (cutter, grid, width, height, atlas=False, repeat=3):
+    """ Times a full shuffle through CutBoard.iter_pieces with the configured workers,
+    as JigsawBoard.get_pieces drives it. """
+    best = None
+    JigsawPuzzleWidget.CUT_ATLAS = atlas
+    try:
+        for n in range(repeat):
+            cb = CutBoard()
+            cb.pb = make_pixbuf(width, height)
+            t = time.perf_counter()
+            cb._prepare(grid, grid, cutter)
+            first = None
+            allocated = 0
+            for pb, pb_wf, mask, px, py, pw, ph in cb.iter_pieces():
+                if first is None:
+                    first = time.perf_counter() - t
+                if not atlas:
+                    allocated += pixbuf_bytes(pb) + pixbuf_bytes(pb_wf) + surface_bytes(mask)
+            total = time.perf_counter() - t
+            if atlas:
+                allocated = pixbuf_bytes(cb.atlas[0]) + surface_bytes(cb.atlas[1])
+            run = {'first_piece': first, 'total': total, 'workers': cb.get_workers(),
+                   'allocated_bytes': allocated}
+            if best is None or total < best['total']:
+                best = run
+    finally:
+        JigsawPuzzleWidget.CUT_ATLAS = False
+    return best
+
+def bench_pick (pieces=1000, cutter='classic', grid=8, area=(800, 600), queries=10000, seed=0):
+    """ Stacks pieces cut from one board at random spots of area and times topmost piece
+    queries through a PickIndex, against testing every piece from the top down. """
+    cb = CutBoard()
+    cb.pb = make_pixbuf(640, 480)
+    cb._prepare(grid, grid, cutter, seed=seed)
+    masks = [PieceMask(mask) for pb, pb_wf, mask, px, py, pw, ph in cb.iter_pieces()]
+    rng = random.Random(seed)
+    stack = []
+    t = time.perf_counter()
+    index = PickIndex()
+    for n in range(pieces):
+        mask = masks[n % len(masks)]
+        x = rng.randint(0, area[0] - mask.width)
+        y = rng.randint(0, area[1] - mask.height)
+        index.add(n, x, y, mask)
+        stack.append((n, x, y, mask))
+    build = time.perf_counter() - t
+    points = [(rng.randint(0, area[0]-1), rng.randint(0, area[1]-1)) for n in range(queries)]
+
+    t = time.perf_counter()
+    picked = [index.pick(x, y) for x, y in points]
+    indexed = time.perf_counter() - t
+
+    def scan (x, y):
+        for n, px, py, mask in reversed(stack):
+            if mask.covers(x - px, y - py):
+                return n
+        return None
+    t = time.perf_counter()
+    scanned = [scan(x, y) for x, y in points]
+    linear = time.perf_counter() - t
+    if picked != scanned:
+        raise AssertionError("PickIndex disagrees with the linear scan")
+
+    return {'pieces': pieces, 'cutter': cutter, 'grid': grid, 'area': list(area),
+            'queries': queries,
+            'build': build,
+            'per_query': indexed / queries,
+            'per_query_linear': linear / queries,
+            'hits': len([p for p in picked if p is not None]),
+            'mean_cell_pieces': float(sum(len(c) for c in index.cells.values())) / len(index.cells),
+            'mask_bytes': sum(len(m) for m in masks),
+            }
+
+def bench_layout (pieces=1000, area=(1200, 900), board=(10, 10, 710, 530), repeat=3, seed=0):
+    """ Times scatter over pieces of random sizes, and counts the overlaps left. """
+    rng = random.Random(seed)
+    sizes = [(rng.randint(25, 45), rng.randint(25, 45)) for n in range(pieces)]
+    best = None
+    for n in range(repeat):
+        t = time.perf_counter()
+        positions = scatter(sizes, area, board, seed)
+        elapsed = time.perf_counter() - t
+        best = best is None and elapsed or min(best, elapsed)
+    overlaps = 0
+    for i, ((x, y), (w, h)) in enumerate(zip(positions, sizes)):
+        for (ox, oy), (ow, oh) in zip(positions[:i], sizes[:i]):
+            if x < ox+ow and ox < x+w and y < oy+oh and oy < y+h:
+                overlaps += 1
+    return {'pieces': pieces, 'area': list(area), 'board': list(board),
+            'time': best, 'overlaps': overlaps,
+            'piece_area_ratio': float(sum([w*h for w, h in sizes])) /
+                                (area[0]*area[1] - board[2]*board[3])}
+
+def bench_shuffle (grid, width=1024, height=768, cutter='classic', workers=1, atlas=False,
+                   tree=None, repeat=3):
+    """ Times a whole shuffle of the tree checkout, cutting every piece and the hint,
+    and dropping the pieces again, with a new interpreter for every run so its peak RSS
+    is that of the one shuffle. Returns the fastest of repeat runs, times in seconds. """
+    tree = os.path.abspath(tree or os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    for n in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', SHUFFLE_SCRIPT, tree, str(grid),
+                                       str(width), str(height), cutter, str(workers),
+                                       atlas and '1' or '0'],
+                                      cwd=tree)
+        run = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        if best is None or run['time'] < best['time']:
+            best = run
+    best.update({'tree': tree, 'grid': grid, 'image': [width, height], 'cutter': cutter,
+                 'workers': workers, 'atlas': atlas})
+    return best
+
+def run_cutter (grids=GRIDS, image_sizes=IMAGE_SIZES, cutters=None, repeat=3):
+    results = []
+    for cutter in cutters or sorted(CUTTERS):
+        for width, height in image_sizes:
+            for grid in grids:
+                entry = {'cutter': cutter, 'grid': grid, 'image': [width, height]}
+                entry.update(bench_cut(cutter, grid, width, height, repeat))
+                entry['pipeline'] = bench_pipeline(cutter, grid, width, height, False, repeat)
+                entry['atlas'] = bench_pipeline(cutter, grid, width, height, True, repeat)
+                sys.stderr.write("%(cutter)-8s %(grid)3ix%(grid)-3i %(image)s %(per_piece).6fs/piece\n" % entry)
+                results.append(entry)
+    return results
+
+def compare (results, baseline, tolerance):
+    """ Prints the time per piece against the baseline. Returns the regressions found. """
+    def key (e):
+        return (e['cutter'], e['grid'], tuple(e['image']))
+    old = dict((key(e), e) for e in baseline.get('results', []))
+    regressions = []
+    for e in results:
+        b = old.get(key(e))
+        if b is None:
+            continue
+        ratio = e['per_piece'] / b['per_piece']
+        flag = ratio > 1.0 + tolerance and 'REGRESSION' or ''
+        sys.stderr.write("%-8s %3ix%-3i %-12s %.6f -> %.6f s/piece (x%.2f) %s\n" % (
+            e['cutter'], e['grid'], e['grid'], tuple(e['image']),
+            b['per_piece'], e['per_piece'], ratio, flag))
+        if flag:
+            regressions.append(e)
+    return regressions
+
+def compare_shuffles (results, baseline):
+    """ Prints the shuffle times, teardown times and peak RSS against the baseline,
+    for every grid run in both. """
+    old = dict((e['grid'], e) for e in baseline.get('results', []))
+    for e in results:
+        b = old.get(e['grid'])
+        if b is None:
+            continue
+        sys.stderr.write("%3ix%-3i shuffle %.4f -> %.4fs (x%.2f), teardown %.4f -> %.4fs, "
+                         "peak RSS %i -> %i KiB\n" % (
+            e['grid'], e['grid'], b['time'], e['time'], e['time'] / b['time'],
+            b['teardown'], e['teardown'], b['rss_peak_bytes'] // 1024,
+            e['rss_peak_bytes'] // 1024))
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Jigsaw Puzzle benchmarks")
+    sub = parser.add_subparsers(dest='bench')
+    p = sub.add_parser('cutter', help="time CutBoard._prepare and CutBoard.cut")
+    p.add_argument('-o', '--output', help="JSON file to write the results to, default stdout")
+    p.add_argument('-b', '--baseline', help="JSON file of a previous run to compare against")
+    p.add_argument('-t', '--tolerance', type=float, default=0.1,
+                   help="allowed slowdown per piece against the baseline, default 0.1")
+    p.add_argument('-g', '--grid', type=int, action='append', help="pieces per line, repeatable")
+    p.add_argument('-c', '--cutter', action='append', choices=sorted(CUTTERS), help="repeatable")
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    p = sub.add_parser('pick', help="time PickIndex queries over stacked pieces")
+    p.add_argument('-o', '--output', help="JSON file to write the results to, default stdout")
+    p.add_argument('-n', '--pieces', type=int, default=1000)
+    p.add_argument('-q', '--queries', type=int, default=10000)
+    p.add_argument('-c', '--cutter', default='classic', choices=sorted(CUTTERS))
+    p = sub.add_parser('layout', help="time the scatter layout of floating pieces")
+    p.add_argument('-o', '--output', help="JSON file to write the results to, default stdout")
+    p.add_argument('-n', '--pieces', type=int, default=1000)
+    p = sub.add_parser('shuffle', help="time whole shuffles of a checkout, by default this one")
+    p.add_argument('-o', '--output', help="JSON file to write the results to, default stdout")
+    p.add_argument('-g', '--grid', type=int, action='append',
+                   help="pieces per line, repeatable, default the three levels")
+    p.add_argument('-c', '--cutter', default='classic', choices=sorted(CUTTERS))
+    p.add_argument('-w', '--workers', type=int, default=1, help="cutting threads, default 1")
+    p.add_argument('-a', '--atlas', action='store_true', help="cut the pieces into an atlas")
+    p.add_argument('--tree', help="checkout to run, such as a git worktree of an older commit")
+    p.add_argument('-b', '--baseline', help="JSON file of a previous shuffle run to compare against")
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    if args.bench == 'layout':
+        results = [bench_layout(args.pieces)]
+        sys.stderr.write("%(pieces)i pieces: %(time).6fs, %(overlaps)i overlaps\n" % results[0])
+        args.baseline = None
+    elif args.bench == 'pick':
+        results = [bench_pick(args.pieces, args.cutter, queries=args.queries)]
+        sys.stderr.write("%(pieces)i pieces: %(per_query).7fs/query indexed, "
+                         "%(per_query_linear).7fs/query scanning\n" % results[0])
+        args.baseline = None
+    elif args.bench == 'shuffle':
+        results = []
+        for grid in args.grid or LEVEL_GRIDS:
+            results.append(bench_shuffle(grid, cutter=args.cutter, workers=args.workers,
+                                         atlas=args.atlas, tree=args.tree, repeat=args.repeat))
+            sys.stderr.write("%(grid)3ix%(grid)-3i %(pieces)4i pieces: %(time).4fs, "
+                             "teardown %(teardown).4fs, peak RSS %(rss_peak_bytes)i bytes\n"
+                             % results[-1])
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare_shuffles(results, json.load(f))
+        args.baseline = None
+    elif args.bench == 'cutter':
+        results = run_cutter(args.grid or GRIDS, IMAGE_SIZES, args.cutter, args.repeat)
+    else:
+        parser.print_help()
+        return 2
+
+    data = {'meta': {'python': platform.python_version(),
+                     'cairo': cairo.cairo_version_string(),
+                     'machine': platform.machine(),
+                     'time': time.time()},
+            'results': results}
+    out = json.dumps(data, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,462 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GObject, Gdk
+
+import logging
+import cairo
+
+from JigsawPuzzleWidget import BoardModel, CutSurface, RepaintStats
+from JigsawPickIndex import PickIndex
+
+BORDER_SIZE = 5
+BORDER_COLOR = (0, 0, 1)
+BOARD_OFFSET = 10
+
+def pixbuf_surface (pb):
+    """ The pixbuf painted on a new image surface, ready to be used as a cairo source. """
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, pb.get_width(), pb.get_height())
+    cr = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(cr, pb, 0, 0)
+    cr.paint()
+    return surface
+
+
+class CanvasPiece (object):
+    """ A piece as drawn by JigsawCanvas, with the parts of the JigsawPiece API
+    the game UI and the network code rely on. Its position and whether it is placed
+    live in the PieceState of the board. """
+    def __init__ (self, state, index, pb, pb_wf, mask):
+        self.state = state
+        self.index = index
+        self.pb = pb
+        self.pb_wf = pb_wf
+        self.mask = mask
+        self.width = pb.get_width()
+        self.height = pb.get_height()
+        self.sensitive = True
+        self.wireframe = pb_wf is not None
+        self._surfaces = {}
+
+    def _get_x (self):
+        return self.state.x[self.index]
+
+    def _set_x (self, x):
+        self.state.x[self.index] = int(x)
+
+    def _get_y (self):
+        return self.state.y[self.index]
+
+    def _set_y (self, y):
+        self.state.y[self.index] = int(y)
+
+    x = property(_get_x, _set_x)
+    y = property(_get_y, _set_y)
+
+    @property
+    def placed (self):
+        return self.state.placed[self.index] == 1
+
+    def get_index (self):
+        return self.index
+
+    def get_width (self):
+        return self.width
+
+    def get_height (self):
+        return self.height
+
+    def get_position (self):
+        return (self.x, self.y)
+
+    def get_rect (self):
+        return (self.x, self.y, self.width, self.height)
+
+    def set_sensitive (self, sensitive):
+        self.sensitive = sensitive
+
+    def hide_wireframe (self):
+        self.wireframe = False
+
+    def get_surface (self):
+        """ The surface to draw, converted from the pixbuf only once. """
+        wireframe = self.wireframe
+        if wireframe not in self._surfaces:
+            self._surfaces[wireframe] = pixbuf_surface(wireframe and self.pb_wf or self.pb)
+        return self._surfaces[wireframe]
+
+class CanvasBoard (GObject.GObject, BoardModel):
+    """ The board model for JigsawCanvas. Pieces placed here are drawn by the canvas,
+    at their target position within the board image. """
+    __gsignals__ = {'solved' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
+                    'placed' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (object,)),
+                    }
+    def __init__ (self):
+        super(CanvasBoard, self).__init__()
+        self._init_model()
+        self.img_width = self.img_height = 0
+        self.placed = []
+        self.hint = None
+
+    def set_image (self, pixbuf):
+        self.placed = []
+        self.img_width = pixbuf.get_width()
+        self.img_height = pixbuf.get_height()
+        self.cutboard.pb = pixbuf
+
+    def get_pieces (self, reshuffle=True):
+        if not self.start_pieces(reshuffle):
+            return
+        for data in self.cutboard.iter_pieces():
+            yield self.add_piece(data)
+
+    def start_pieces (self, reshuffle=True):
+        """ Prepares the cut, before any piece is added. The hint is only rendered
+        once it is drawn. Returns False if there is no image to cut. """
+        if not self.prepare_cut(reshuffle):
+            return False
+        self.hint = None
+        return True
+
+    def get_hint (self):
+        """ The hint surface of the current cut, rendered on first use. """
+        if self.hint is None:
+            self.hint = pixbuf_surface(self.cutboard.get_hint())
+        return self.hint
+
+    def add_piece (self, data):
+        """ Makes the piece for a piece tuple, as cut by CutBoard.iter_pieces. """
+        pb, pb_wf, mask, px, py, pw, ph = data
+        index = self.add_piece_data(data)
+        piece = CanvasPiece(self.state, index, pb, pb_wf, mask)
+        self.state.pieces[index] = piece
+        return piece
+
+    def get_placed_pieces (self):
+        return list(self.placed)
+
+    def place_piece (self, piece):
+        """ Places piece on the board, along with every piece joined to it. """
+        self.place_pieces([piece])
+
+    def place_pieces (self, pieces):
+        """ Places all pieces on the board, along with every piece joined to them,
+        emitting solved at most once. """
+        solved = False
+        for p in self.get_unplaced_clusters(pieces):
+            solved = self.set_placed(p.get_index()) or solved
+            self.placed.append(p)
+            self.emit('placed', p)
+        if solved:
+            for p in self.placed:
+                p.hide_wireframe()
+            self.emit('solved')
+
+    def drop_piece (self, piece, x, y):
+        if self.fits(piece.get_index(), x, y):
+            # We have a positive positioning
+            self.place_piece(piece)
+
+
+class JigsawCanvas (Gtk.DrawingArea, CutSurface):
+    """ A play surface drawing the board and every piece on a single window.
+    Pieces live in a scene list, bottom to top, and the canvas does its own hit testing,
+    dragging and stacking, only repainting the areas that changed. It has the same
+    signals and methods as JigsawPuzzleWidget, so the game UI can use either. """
+    __gsignals__ = {
+        'picked' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (object,)),
+        'dropped' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (object,bool)),
+        'solved' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
+        'cutter-changed' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (str, int)),
+        'cut-progress' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (int, int)),
+        'cut-done' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
+        }
+    def __init__ (self):
+        super(JigsawCanvas, self).__init__()
+        self.board = CanvasBoard()
+        self.board.connect('solved', self._solved_cb)
+        self.board.connect('placed', self._placed_cb)
+        self.board_x = self.board_y = BOARD_OFFSET
+        self.scene = []
+        self._scene_dirty = False
+        self.pick_index = PickIndex()
+        # Cluster root index -> (surface, anchor piece, x, y offset from the anchor)
+        self._composites = {}
+        self.hint_visible = False
+        self.repaint_stats = RepaintStats()
+        self.drag = None
+        self._init_cut()
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK |
+                        Gdk.EventMask.BUTTON_RELEASE_MASK |
+                        Gdk.EventMask.BUTTON1_MOTION_MASK)
+        self.connect('draw', self._draw_cb)
+        self.connect('button-press-event', self._press_cb)
+        self.connect('motion-notify-event', self._motion_cb)
+        self.connect('button-release-event', self._release_cb)
+
+    def get_board_rect (self):
+        """ The board area, border included, in canvas coordinates. """
+        return (self.board_x, self.board_y,
+                self.board.img_width + 2*BORDER_SIZE, self.board.img_height + 2*BORDER_SIZE)
+
+    def get_image_origin (self):
+        """ Where the board image starts, in canvas coordinates. """
+        return self.board_x + BORDER_SIZE, self.board_y + BORDER_SIZE
+
+    def damage (self, x, y, w, h):
+        self.queue_draw_area(int(x)-1, int(y)-1, int(w)+2, int(h)+2)
+
+    def bring_to_top (self, piece):
+        """ Raises piece and every piece joined to it, piece last. """
+        if piece not in self.pick_index:
+            return
+        self._prune_scene()
+        if self.scene[-1] is piece:
+            return
+        cluster = [p for p in self.board.get_cluster(piece) if p is not piece] + [piece]
+        for p in cluster:
+            self.scene.remove(p)
+            self.scene.append(p)
+            self.pick_index.raise_to_top(p)
+        self.damage(*self.get_cluster_rect(piece))
+
+    def get_cluster_rect (self, piece):
+        """ The bounds of piece and every piece joined to it. """
+        members = self.board.get_cluster(piece)
+        if len(members) == 1:
+            return piece.get_rect()
+        x0 = min([p.x for p in members])
+        y0 = min([p.y for p in members])
+        x1 = max([p.x + p.width for p in members])
+        y1 = max([p.y + p.height for p in members])
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def get_composite (self, piece):
+        """ The cluster of piece painted on one surface, built once per cluster.
+        Returns the surface and where to draw it. """
+        root = self.board.clusters.find(piece.get_index())
+        if root not in self._composites:
+            x, y, w, h = self.get_cluster_rect(piece)
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(w), int(h))
+            cr = cairo.Context(surface)
+            for p in self.board.get_cluster(piece):
+                cr.set_source_surface(p.get_surface(), p.x - x, p.y - y)
+                cr.paint()
+            self._composites[root] = (surface, piece, x - piece.x, y - piece.y)
+        surface, anchor, dx, dy = self._composites[root]
+        return surface, anchor.x + dx, anchor.y + dy
+
+    def show_hint (self, show):
+        self.hint_visible = show
+        self.damage(*self.get_board_rect())
+
+    def get_floating_pieces (self):
+        """ The floating pieces, bottom to top. """
+        self._prune_scene()
+        return list(self.scene)
+
+    def get_floating_piece (self, index):
+        """ The floating piece of the given index, None if it is placed or not cut yet. """
+        piece = self.board.get_piece(index)
+        if piece is None or piece not in self.pick_index:
+            return None
+        return piece
+
+    def get_piece_position (self, piece):
+        """ Where floating piece is on the canvas. """
+        return self.board.state.get_position(piece.get_index())
+
+    def set_cutter (self, cutter):
+        if cutter is None:
+            cutter = 'classic'
+            logging.debug('set_cutter(None) setting default to "classic"')
+        self.board.set_cutter(cutter)
+        self.emit('cutter-changed', self.get_cutter(), self.board.target_pieces_per_line)
+
+    def get_cutter (self):
+        return self.board.get_cutter()
+
+    def set_target_pieces_per_line (self, tppl):
+        if tppl is None:
+            tppl = 3
+        self.board.target_pieces_per_line = tppl
+        self.emit('cutter-changed', self.get_cutter(), self.board.target_pieces_per_line)
+
+    def get_target_pieces_per_line (self):
+        return self.board.target_pieces_per_line
+
+    def _clear_pieces (self):
+        self.scene = []
+        self.pick_index.clear()
+        self._composites = {}
+        self.drag = None
+
+    def _put_floating (self, piece, x, y):
+        piece.x, piece.y = x, y
+        self.scene.append(piece)
+        self.pick_index.add(piece, piece.x, piece.y, piece.mask)
+        self.damage(*piece.get_rect())
+
+    def piece_at (self, x, y):
+        """ The topmost floating piece drawn at x,y, or None. """
+        return self.pick_index.pick(x, y, lambda piece: piece.sensitive)
+
+    def move_piece (self, piece, x, y):
+        """ Moves piece to x,y, along with every piece joined to it, repainting only
+        the area they left and the one they cover now. """
+        dx, dy = x - piece.x, y - piece.y
+        self.damage(*self.get_cluster_rect(piece))
+        for p in self.board.get_cluster(piece):
+            p.x += dx
+            p.y += dy
+            self.pick_index.move(p, p.x, p.y)
+        self.damage(*self.get_cluster_rect(piece))
+
+    def _solved_cb (self, *args):
+        self.emit('solved')
+
+    def _prune_scene (self):
+        """ Drops placed pieces from the scene, which is only done when needed so
+        placing many pieces at once stays linear. """
+        if self._scene_dirty:
+            self.scene = [p for p in self.scene if not p.placed]
+            self._scene_dirty = False
+
+    def _placed_cb (self, board, piece):
+        if piece in self.pick_index:
+            self.damage(*piece.get_rect())
+            self.pick_index.remove(piece)
+            self._scene_dirty = True
+        if self.drag is not None and self.drag[0] is piece:
+            self.drag = None
+        ox, oy = self.get_image_origin()
+        tx, ty = self.board.get_target(piece.get_index())
+        piece.x, piece.y = ox + tx, oy + ty
+        self.damage(*piece.get_rect())
+
+    def _press_cb (self, w, e):
+        if e.button != 1:
+            return False
+        piece = self.piece_at(e.x, e.y)
+        if piece is None:
+            return False
+        self.drag = (piece, e.x - piece.x, e.y - piece.y)
+        self.repaint_stats.reset()
+        self.bring_to_top(piece)
+        self.emit('picked', piece)
+        return True
+
+    def _motion_cb (self, w, e):
+        if self.drag is None:
+            return False
+        piece, dx, dy = self.drag
+        self._move_cb(piece, e.x - dx, e.y - dy, absolute=True)
+        return True
+
+    def _release_cb (self, w, e):
+        if self.drag is None:
+            return False
+        piece = self.drag[0]
+        self.drag = None
+        logging.debug("Drag repainted %i pixels per frame over %i frames" % (
+                self.repaint_stats.get_average(), self.repaint_stats.frames))
+        self._drop_cb(piece)
+        return True
+
+    def _move_cb (self, piece, x, y, absolute=False):
+        if piece.placed:
+            return
+        if not absolute:
+            x += piece.x
+            y += piece.y
+        alloc = self.get_allocation()
+        cx, cy, cw, ch = self.get_cluster_rect(piece)
+        cx += x - piece.x
+        cy += y - piece.y
+        if cx > 0 and cy > 0 and cx+cw <= alloc.width and cy+ch <= alloc.height:
+            self.move_piece(piece, x, y)
+
+    def _drop_cb (self, piece, from_mesh=False):
+        if piece.placed:
+            return
+        self.bring_to_top(piece)
+        bx, by, bw, bh = self.get_board_rect()
+        if piece.x < bx+bw and bx < piece.x+piece.width and \
+                piece.y < by+bh and by < piece.y+piece.height:
+            ox, oy = self.get_image_origin()
+            self.board.drop_piece(piece, piece.x - ox, piece.y - oy)
+        if not piece.placed:
+            snap = self.board.find_snap(piece.get_index())
+            if snap is not None:
+                self.move_piece(piece, piece.x + snap[0], piece.y + snap[1])
+                joined = self.board.join_aligned(piece.get_index())
+                if joined:
+                    # Only the composites of the clusters just joined are out of date
+                    for root in joined:
+                        self._composites.pop(root, None)
+                    self.bring_to_top(piece)
+        self.emit('dropped', piece, from_mesh)
+
+    def _draw_cb (self, w, cr):
+        alloc = self.get_allocation()
+        Gtk.render_background(self.get_style_context(), cr, 0, 0, alloc.width, alloc.height)
+        self.repaint_stats.add(cr)
+        x0, y0, x1, y1 = cr.clip_extents()
+        def damaged (x, y, w, h):
+            return x < x1 and y < y1 and x+w > x0 and y+h > y0
+
+        if self.board.cutboard.pb is None:
+            return False
+        bx, by, bw, bh = self.get_board_rect()
+        if damaged(bx, by, bw, bh):
+            ox, oy = self.get_image_origin()
+            cr.set_source_rgb(*BORDER_COLOR)
+            cr.rectangle(bx, by, bw, bh)
+            cr.fill()
+            cr.set_source_rgb(1, 1, 1)
+            cr.rectangle(ox, oy, self.board.img_width, self.board.img_height)
+            cr.fill()
+            if self.hint_visible:
+                cr.set_source_surface(self.board.get_hint(), ox, oy)
+                cr.paint()
+        for piece in self.board.placed:
+            if damaged(*piece.get_rect()):
+                cr.set_source_surface(piece.get_surface(), piece.x, piece.y)
+                cr.paint()
+        drawn = set()
+        self._prune_scene()
+        for piece in self.scene:
+            if len(self.board.get_cluster(piece)) == 1:
+                if damaged(*piece.get_rect()):
+                    cr.set_source_surface(piece.get_surface(), piece.x, piece.y)
+                    cr.paint()
+                continue
+            # Joined pieces are drawn together, from the composite of their cluster
+            root = self.board.clusters.find(piece.get_index())
+            if root in drawn:
+                continue
+            drawn.add(root)
+            if damaged(*self.get_cluster_rect(piece)):
+                surface, x, y = self.get_composite(piece)
+                cr.set_source_surface(surface, x, y)
+                cr.paint()
+        return False
@@ -0,0 +1,197 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib, GdkPixbuf
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+import cairo
+
+MAGIC = b'JPCUT1\n'
+# Default size budget for the whole cache directory
+CACHE_SIZE = 32*1024*1024
+
+def image_digest (pb):
+    """ A digest of the pixbuf pixels and layout, used to recognize the same board image. """
+    digest = hashlib.md5()
+    digest.update(("%i %i %i %i " % (pb.get_width(), pb.get_height(),
+                                     pb.get_rowstride(), pb.get_n_channels())).encode())
+    digest.update(pb.read_pixel_bytes().get_data())
+    return digest.hexdigest()
+
+def _pixbuf_rows (pb):
+    """ The pixbuf pixels without the row padding, which also strips the rest of the
+    atlas from sub pixbufs. """
+    data = pb.read_pixel_bytes().get_data()
+    stride = pb.get_rowstride()
+    row = pb.get_width() * pb.get_n_channels()
+    if stride == row:
+        return data[:row*pb.get_height()]
+    return b''.join([data[r*stride:r*stride+row] for r in range(pb.get_height())])
+
+def mask_image (mask):
+    """ The mask as an A1 image surface, coercing the sub surfaces of an atlas. """
+    if isinstance(mask, cairo.ImageSurface):
+        mask.flush()
+        return mask
+    cr = cairo.Context(mask)
+    x0, y0, x1, y1 = cr.clip_extents()
+    image = cairo.ImageSurface(cairo.FORMAT_A1, int(x1-x0), int(y1-y0))
+    cr = cairo.Context(image)
+    cr.set_source_surface(mask, 0, 0)
+    cr.paint()
+    image.flush()
+    return image
+
+class CutCache (object):
+    """ A content addressed disk cache for cut boards.
+    Every entry holds all pieces of one cut: their pixbuf pixels, masks, crop origins
+    and sizes, keyed by the board image digest, the grid, the cutter and the connector
+    hints. Entries are plain files in one directory, evicted least recently used first
+    once the directory grows over max_bytes, and read back through mmap. """
+    def __init__ (self, path, max_bytes=CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key (self, digest, cols, rows, cutter, hints):
+        """ hints is either the connector hint seed or the (horizontal, vertical) hint lists. """
+        if isinstance(hints, int):
+            hints = 'seed:%i' % hints
+        else:
+            hints = 'hints:' + ''.join(['%i' % (h >= 0) for hl in hints for h in hl])
+        return hashlib.md5(("%s %ix%i %s %s" % (digest, cols, rows, cutter, hints)).encode()).hexdigest()
+
+    def _filename (self, key):
+        return os.path.join(self.path, '%s.cut' % key)
+
+    def load (self, key):
+        """ Returns the list of piece tuples stored under key, or None. """
+        fn = self._filename(key)
+        try:
+            with open(fn, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if m[:len(MAGIC)] != MAGIC:
+                        raise ValueError("not a cut cache file")
+                    start = len(MAGIC) + 4
+                    hlen = struct.unpack('<I', m[len(MAGIC):start])[0]
+                    header = json.loads(m[start:start+hlen].decode())
+                    base = start + hlen
+                    pieces = [self._load_piece(m, base, p) for p in header['pieces']]
+            os.utime(fn, None)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(fn):
+                logging.debug("Dropping unreadable cut cache entry %s: %s" % (fn, e))
+                self._remove(fn)
+            return None
+        return pieces
+
+    def _load_piece (self, m, base, p):
+        w, h = p['size']
+        pbs = []
+        for offset in p['pixbufs']:
+            data = GLib.Bytes.new(m[base+offset:base+offset+w*h*4])
+            pbs.append(GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+                                                       True, 8, w, h, w*4))
+        offset, stride = p['mask']
+        mask = cairo.ImageSurface.create_for_data(bytearray(m[base+offset:base+offset+stride*h]),
+                                                  cairo.FORMAT_A1, w, h, stride)
+        return (pbs[0], pbs[1], mask) + tuple(p['origin']) + tuple(p['nominal'])
+
+    def store (self, key, pieces):
+        """ Writes the piece tuples, as cut by CutBoard, under key. """
+        header = []
+        blobs = []
+        offset = 0
+        for pb, pb_wf, mask, px, py, pw, ph in pieces:
+            entry = {'size': (pb.get_width(), pb.get_height()),
+                     'origin': (px, py),
+                     'nominal': (pw, ph),
+                     'pixbufs': []}
+            for p in (pb, pb_wf):
+                if not p.get_has_alpha() or p.get_n_channels() != 4:
+                    logging.debug("Not caching pieces without an alpha channel")
+                    return
+                data = _pixbuf_rows(p)
+                entry['pixbufs'].append(offset)
+                blobs.append(data)
+                offset += len(data)
+            mask = mask_image(mask)
+            data = bytes(mask.get_data())
+            entry['mask'] = (offset, mask.get_stride())
+            blobs.append(data)
+            offset += len(data)
+            header.append(entry)
+        header = json.dumps({'pieces': header}).encode()
+        with self._lock:
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(MAGIC)
+                    f.write(struct.pack('<I', len(header)))
+                    f.write(header)
+                    for data in blobs:
+                        f.write(data)
+                os.replace(tmp, self._filename(key))
+            except (IOError, OSError) as e:
+                logging.error("Failed to write cut cache entry: %s" % e)
+                self._remove(tmp)
+                return
+            self.evict()
+
+    def store_async (self, key, pieces):
+        """ Stores in a background thread, so the caller does not wait on the disk. """
+        t = threading.Thread(target=self.store, args=(key, pieces))
+        t.daemon = True
+        t.start()
+
+    def evict (self):
+        """ Removes the least recently used entries until the cache fits max_bytes. """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            fn = os.path.join(self.path, name)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+            total += st.st_size
+        entries.sort()
+        while entries and total > self.max_bytes:
+            mtime, size, fn = entries.pop(0)
+            self._remove(fn)
+            total -= size
+
+    def _remove (self, fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
@@ -0,0 +1,118 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+import random
+
+def free_regions (area, avoid=None):
+    """ Splits the (width, height) area into the (x, y, width, height) rectangles around
+    the avoid rectangle, largest first. """
+    width, height = area
+    if avoid is None:
+        return [(0, 0, width, height)]
+    bx, by, bw, bh = avoid
+    bx, by = max(0, bx), max(0, by)
+    bx1, by1 = min(width, bx + bw), min(height, by + bh)
+    regions = [(bx1, 0, width - bx1, height),
+               (0, 0, bx, height),
+               (bx, 0, bx1 - bx, by),
+               (bx, by1, bx1 - bx, height - by1)]
+    regions = [r for r in regions if r[2] > 0 and r[3] > 0]
+    regions.sort(key=lambda r: -r[2]*r[3])
+    return regions
+
+def _pack_region (region, items, sizes, rng, positions):
+    """ Packs as many of the items (indices into sizes) as fit in region on shelves,
+    spreading the left over space between them. Returns the items that did not fit. """
+    rx, ry, rw, rh = region
+    shelves = []
+    shelf = []
+    x = y = shelf_height = 0
+    left = []
+    for i in items:
+        w, h = sizes[i]
+        if w > rw or h > rh:
+            left.append(i)
+            continue
+        if x + w > rw:
+            if shelf:
+                shelves.append((shelf, x, shelf_height))
+            y += shelf_height
+            shelf = []
+            x = shelf_height = 0
+        if y + h > rh:
+            left.append(i)
+            continue
+        shelf.append(i)
+        x += w
+        shelf_height = max(shelf_height, h)
+    if shelf:
+        shelves.append((shelf, x, shelf_height))
+    if not shelves:
+        return left
+
+    # Spread the shelves over the region height and the pieces over each shelf width.
+    # Jitter stays within half the gap on each side, so nothing overlaps.
+    used_height = sum([s[2] for s in shelves])
+    gap_y = float(rh - used_height) / (len(shelves) + 1)
+    sy = ry + gap_y
+    for shelf, used_width, shelf_height in shelves:
+        gap_x = float(rw - used_width) / (len(shelf) + 1)
+        sx = rx + gap_x
+        for i in shelf:
+            w, h = sizes[i]
+            jx = rng.uniform(-gap_x/2, gap_x/2)
+            jy = rng.uniform(-gap_y/2, gap_y/2 + shelf_height - h)
+            positions[i] = (int(sx + jx), int(max(ry, min(ry + rh - h, sy + jy))))
+            sx += w + gap_x
+        sy += shelf_height + gap_y
+    return left
+
+def scatter (sizes, area, avoid=None, seed=None):
+    """ Lays out pieces of the given (width, height) sizes over the (width, height)
+    area, outside of the (x, y, width, height) avoid rectangle.
+    Pieces are shelf packed in random order over the free space, so none overlap while
+    space allows. Whatever does not fit is packed again over the same space, in as many
+    layers as needed, and if the free space is too small for a piece the whole area is
+    used. The same seed always gives the same layout. Returns the (x, y) of each piece. """
+    rng = random.Random(seed)
+    positions = [None] * len(sizes)
+    items = list(range(len(sizes)))
+    rng.shuffle(items)
+    regions = free_regions(area, avoid)
+    while items:
+        left = items
+        for region in regions:
+            left = _pack_region(region, left, sizes, rng, positions)
+            if not left:
+                break
+        if len(left) == len(items):
+            if avoid is not None:
+                # No free space fits them, fall back to the whole area
+                regions = free_regions(area)
+                avoid = None
+                continue
+            # Bigger than the area itself
+            for i in left:
+                w, h = sizes[i]
+                positions[i] = (rng.randint(0, max(0, area[0] - w)),
+                                rng.randint(0, max(0, area[1] - h)))
+            break
+        items = left
+    return positions
@@ -0,0 +1,142 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+import sys
+
+from JigsawCutCache import mask_image
+
+# Side of the square grid cells pieces are bucketed in, in pixels
+CELL_SIZE = 64
+
+class PieceMask (object):
+    """ A packed 1 bit per pixel copy of a piece mask, as cut by CutBoard.
+    Rows are kept as cairo lays out A1 surfaces, which is in native endian 32 bit words,
+    so the pixel order within each byte depends on the machine. """
+    LSB_FIRST = sys.byteorder == 'little'
+
+    def __init__ (self, mask):
+        mask = mask_image(mask)
+        self.width = mask.get_width()
+        self.height = mask.get_height()
+        self.stride = mask.get_stride()
+        self.bits = bytes(mask.get_data())
+
+    def __len__ (self):
+        return len(self.bits)
+
+    def covers (self, x, y):
+        """ Tests pixel x,y, relative to the mask origin. """
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        byte = self.bits[y*self.stride + (x >> 3)]
+        if self.LSB_FIRST:
+            return (byte >> (x & 7)) & 1 == 1
+        return (byte >> (7 - (x & 7))) & 1 == 1
+
+
+class PickIndex (object):
+    """ Finds the topmost piece drawn at a point.
+    Every piece is kept with its position, its packed mask and a stacking order, and
+    bucketed by bounding box in a uniform grid, so a query only tests the masks of the
+    pieces sharing the grid cell of the point. Keys are whatever the caller uses to
+    name pieces, usually the piece objects themselves. """
+    def __init__ (self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.clear()
+
+    def clear (self):
+        self.entries = {}
+        self.cells = {}
+        self._z = 0
+
+    def __len__ (self):
+        return len(self.entries)
+
+    def __contains__ (self, key):
+        return key in self.entries
+
+    def _cells (self, x, y, w, h):
+        cs = self.cell_size
+        for cx in range(int(x) // cs, (int(x) + w - 1) // cs + 1):
+            for cy in range(int(y) // cs, (int(y) + h - 1) // cs + 1):
+                yield (cx, cy)
+
+    def _bucket (self, key, entry):
+        for cell in self._cells(entry[0], entry[1], entry[2].width, entry[2].height):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def _unbucket (self, key, entry):
+        for cell in self._cells(entry[0], entry[1], entry[2].width, entry[2].height):
+            bucket = self.cells.get(cell)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.cells[cell]
+
+    def add (self, key, x, y, mask):
+        """ Adds a piece at x,y above every other one. mask is either a cairo mask
+        surface or an already packed PieceMask. """
+        if key in self.entries:
+            self.remove(key)
+        if not isinstance(mask, PieceMask):
+            mask = PieceMask(mask)
+        self._z += 1
+        entry = [x, y, mask, self._z]
+        self.entries[key] = entry
+        self._bucket(key, entry)
+
+    def remove (self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._unbucket(key, entry)
+
+    def move (self, key, x, y):
+        entry = self.entries[key]
+        if int(x) // self.cell_size == int(entry[0]) // self.cell_size and \
+                int(y) // self.cell_size == int(entry[1]) // self.cell_size and \
+                (int(x) + entry[2].width - 1) // self.cell_size == \
+                (int(entry[0]) + entry[2].width - 1) // self.cell_size and \
+                (int(y) + entry[2].height - 1) // self.cell_size == \
+                (int(entry[1]) + entry[2].height - 1) // self.cell_size:
+            # Still in the same cells, which is the common case while dragging
+            entry[0], entry[1] = x, y
+            return
+        self._unbucket(key, entry)
+        entry[0], entry[1] = x, y
+        self._bucket(key, entry)
+
+    def raise_to_top (self, key):
+        self._z += 1
+        self.entries[key][3] = self._z
+
+    def pick (self, x, y, accept=None):
+        """ Returns the key of the topmost piece whose mask covers x,y, or None.
+        If accept is given, pieces it returns False for are ignored. """
+        bucket = self.cells.get((int(x) // self.cell_size, int(y) // self.cell_size))
+        if not bucket:
+            return None
+        best = None
+        best_z = 0
+        for key in bucket:
+            px, py, mask, z = self.entries[key]
+            if z > best_z and mask.covers(int(x - px), int(y - py)) and \
+                    (accept is None or accept(key)):
+                best, best_z = key, z
+        return best
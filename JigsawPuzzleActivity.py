@@ -42,7 +42,11 @@ from io import StringIO
 from mamamedia_modules import json
 
 from JigsawPuzzleUI import JigsawPuzzleUI
+import JigsawPuzzleWidget
+from JigsawCutCache import CutCache
 from mamamedia_modules import TubeHelper
+from mamamedia_modules import image_category, ImageCatalog, ImageIndex
+from mamamedia_modules import utils
 from mamamedia_modules import GAME_IDLE, GAME_STARTED, GAME_FINISHED, GAME_QUIT
 import logging
 _logger = logging.getLogger('jigsawpuzzle-activity')
@@ -241,6 +245,15 @@ class JigsawPuzzleActivity(Activity, TubeHelper):
         Activity.__init__(self, handle)
         logger.debug('Starting Jigsaw Puzzle activity... %s' % str(get_bundle_path()))
         os.chdir(get_bundle_path())
+        try:
+            JigsawPuzzleWidget.CUT_CACHE = CutCache(
+                os.path.join(self.get_activity_root(), 'data', 'cutcache'))
+        except OSError as e:
+            logger.error("Cut cache disabled: %s" % e)
+        image_category.CATALOG = ImageCatalog(
+            os.path.join(self.get_activity_root(), 'data', 'catalog.json'))
+        image_category.IMAGE_INDEX = ImageIndex(image_category.CATALOG)
+        utils.PIXBUF_CACHE = utils.PixbufCache()
 
         self.connect('destroy', self._destroy_cb)
         
@@ -304,6 +317,12 @@ class JigsawPuzzleActivity(Activity, TubeHelper):
         TubeHelper.__init__(self, tube_class=GameTube, service=SERVICE)
 
     def _destroy_cb(self, data=None):
+        if image_category.IMAGE_INDEX is not None:
+            image_category.IMAGE_INDEX.stop()
+        if image_category.CATALOG is not None:
+            image_category.CATALOG.flush()
+        if utils.PIXBUF_CACHE is not None:
+            logger.debug("Pixbuf cache: %s" % utils.PIXBUF_CACHE.get_stats())
         return True
 
     def new_tube_cb (self):
@@ -35,6 +35,7 @@ from mamamedia_modules import BuddyPanel, BUDDYMODE_COLLABORATION
 from mamamedia_modules import GAME_IDLE, GAME_STARTED, GAME_FINISHED
 
 from JigsawPuzzleWidget import JigsawPuzzleWidget
+from JigsawCanvas import JigsawCanvas
 
 import logging
 logger = logging.getLogger('jigsawPuzzle-activity')
@@ -46,6 +47,9 @@ from sugar3.graphics.objectchooser import ObjectChooser
 
 #from gettext import gettext as _
 
+# Draw the game on a single JigsawCanvas instead of one widget per piece
+USE_CANVAS = False
+
 # Colors from Rich's UI design
 
 COLOR_FRAME_OUTER = "#B7B7B7"
@@ -104,11 +108,15 @@ class JigsawPuzzleUI (BorderFrame):
         inner_table = Gtk.Table(2,2,False)
         self.add(inner_table)
 
-        self.game = JigsawPuzzleWidget()
+        if USE_CANVAS:
+            self.game = JigsawCanvas()
+        else:
+            self.game = JigsawPuzzleWidget()
         self.game.connect('picked', self.piece_pick_cb, False)
         self.game.connect('dropped', self.piece_drop_cb)
         self.game.connect('solved', self.do_solve)
         self.game.connect('cutter-changed', self.cutter_change_cb)
+        self.game.connect('cut-done', self.cut_done_cb)
         self.game.show()
 
         # panel is a holder for everything on the left side down to (not inclusive) the language dropdown
@@ -399,13 +407,17 @@ class JigsawPuzzleUI (BorderFrame):
         win = self.get_window()
         if win:
             win.set_cursor(c)
-        if not self.game.prepare_image(pixbuf, reshuffle):
-            self._shuffling = False
-            return
+        # The pieces are cut in the background, a newer shuffle supersedes this one
+        cutting = self.game.prepare_image(pixbuf, reshuffle) and self.game.is_cutting()
         self._shuffling = False
+        if not cutting:
+            self.cut_done_cb(self.game)
+        #self.game.randomize()
+
+    def cut_done_cb (self, o, *args):
+        win = self.get_window()
         if win:
             win.set_cursor(None)
-        #self.game.randomize()
 
     def do_shuffle (self, o, *args):
         #if self.thumb.has_image():
@@ -419,6 +431,8 @@ class JigsawPuzzleUI (BorderFrame):
             logging.debug('do_shuffle')
             self.timer.start()
         elif self.thumb.has_image():
+            # _show_game runs the main loop until the game is shown, which may get here
+            # again. Once the cut is started, a new shuffle supersedes it instead.
             if not self._shuffling:
                 logging.debug('do_shuffle start')
                 self.timer.stop()
@@ -569,12 +583,21 @@ class JigsawPuzzleUI (BorderFrame):
         if self._parent.shared_activity:
             self._parent.game_tube.PiecePicked(piece.get_index())
 
+    def _get_remote_piece (self, index):
+        """ The floating piece of the given index, for a remote player to act on. If it
+        is not cut yet, the running cut is finished first so the move is not lost. """
+        piece = self.game.get_floating_piece(index)
+        if piece is None and self.game.is_cutting():
+            self.game.finish_cut()
+            piece = self.game.get_floating_piece(index)
+        return piece
+
     @utils.trace
     def _recv_pick_notification (self, index):
-        for piece in self.game.get_floating_pieces():
-            if piece.get_index() == index:
-                logging.debug("Remote picked piece %s" % piece)
-                piece.set_sensitive(False)
+        piece = self._get_remote_piece(index)
+        if piece is not None:
+            logging.debug("Remote picked piece %s" % piece)
+            piece.set_sensitive(False)
                 
     @utils.trace
     def _send_drop_notification (self, piece):
@@ -582,17 +605,16 @@ class JigsawPuzzleUI (BorderFrame):
         if piece.placed:
             self._parent.game_tube.PiecePlaced(piece.get_index())
         else:
-            self._parent.game_tube.PieceDropped(piece.get_index(), piece.get_position())
+            self._parent.game_tube.PieceDropped(piece.get_index(), self.game.get_piece_position(piece))
     
     @utils.trace
     def _recv_drop_notification (self, index, position=None):
-        for piece in self.game.get_floating_pieces():
-            if piece.get_index() == index:
-                logging.debug("Moving piece %s" % piece)
-                if position is None:
-                    self.game.board.place_piece(piece)
-                else:
-                    self.game._move_cb(piece, position[0], position[1], absolute=True)
-                    self.game._drop_cb(piece, from_mesh=True)
-                piece.set_sensitive(True)
-                break
+        piece = self._get_remote_piece(index)
+        if piece is not None:
+            logging.debug("Moving piece %s" % piece)
+            if position is None:
+                self.game.board.place_piece(piece)
+            else:
+                self.game._move_cb(piece, position[0], position[1], absolute=True)
+                self.game._drop_cb(piece, from_mesh=True)
+            piece.set_sensitive(True)
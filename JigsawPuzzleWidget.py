@@ -28,13 +28,39 @@ import random
 import os
 import logging
 import hashlib
+import math
 import cairo
 import tempfile
+import threading
+import copy
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO, BytesIO
 from mmm_modules import BorderFrame, utils
+from JigsawCutCache import image_digest
+from JigsawPickIndex import PickIndex
+from JigsawLayout import scatter
 
 MAGNET_POWER_PERCENT = 20
 CUTTERS = {}
+# Number of threads used to cut pieces, None meaning one per available core.
+CUT_WORKERS = None
+# How many pieces may be cut ahead of the one being consumed, None meaning twice CUT_WORKERS.
+CUT_LOOKAHEAD = None
+# Store all pieces of a board in one atlas pixbuf instead of separate pixbufs per piece.
+CUT_ATLAS = False
+# A JigsawCutCache.CutCache to reuse earlier cuts of the same board from, None to always cut.
+CUT_CACHE = None
+# Pick pieces through a JigsawPickIndex instead of shaping the window of every piece.
+PICK_INDEX = True
+# While dragging, only reallocate the dragged pieces and repaint the areas they leave
+# and cover, moving them in the container once dropped.
+DRAG_DAMAGE_ONLY = True
+# Add up the motion of a dragged piece and move it at most once per frame.
+COALESCE_MOTION = True
+# Cut pieces on a worker thread, handing them to the main loop as they are ready.
+CUT_IN_BACKGROUND = True
 
 def create_surface(w, h, source_pixbuf=None):
     """Create a  image surface of given width and height."""
@@ -50,6 +76,48 @@ def create_surface(w, h, source_pixbuf=None):
 
     return surface
 
+def copy_surface (target, source):
+    """ Replaces the content of target, which may be a sub surface, with source. """
+    cr = cairo.Context(target)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.set_source_surface(source, 0, 0)
+    cr.paint()
+
+def pack_shelves (sizes, max_width):
+    """ Packs rectangles of the given (width, height) sizes, in order, on horizontal
+    shelves no wider than max_width (unless a single rectangle is wider).
+    Returns the (x, y) of each rectangle and the total (width, height) used. """
+    positions = []
+    x = y = shelf_height = width = 0
+    for w, h in sizes:
+        if x > 0 and x + w > max_width:
+            y += shelf_height
+            x = shelf_height = 0
+        positions.append((x, y))
+        x += w
+        width = max(width, x)
+        shelf_height = max(shelf_height, h)
+    return positions, width, y + shelf_height
+
+class RepaintStats (object):
+    """ Counts the pixels a widget repaints, frame by frame, to be fed from its draw handler. """
+    def __init__ (self):
+        self.reset()
+
+    def reset (self):
+        self.frames = 0
+        self.pixels = 0
+        self.last = 0
+
+    def add (self, cr):
+        x0, y0, x1, y1 = cr.clip_extents()
+        self.last = int((x1 - x0) * (y1 - y0))
+        self.frames += 1
+        self.pixels += self.last
+
+    def get_average (self):
+        return self.frames and self.pixels / self.frames or 0
+
 class JigsawPiece(Gtk.EventBox):
     __gsignals__ = {'picked' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
                     'moved' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (int, int)),
@@ -62,9 +130,17 @@ class JigsawPiece(Gtk.EventBox):
         self.root_coords = (0,0)
         self.last_coords = (0,0)
         self.shape = None
+        self.mask = None
+        self.shaped = True
         self.image = Gtk.Image()
         self.pb_wf = Gtk.Image()
         self.placed = False
+        # Motion not yet emitted as 'moved', and the frame clock tick callback that will
+        # emit it, added up, once per frame
+        self._pending_motion = (0, 0)
+        self._tick_id = None
+        # Motion events received and moves emitted during the current drag
+        self.motion_stats = [0, 0]
         self._prepare_ui()
         self._prepare_event_callbacks()
 
@@ -93,13 +169,21 @@ class JigsawPiece(Gtk.EventBox):
         self.image.set_from_pixbuf(pb)
         self.width = pb.get_width()
         self.height = pb.get_height()
-        self.shape = mask
+        self.mask = mask
+        self.shape = self.shaped and mask or None
         if pb_wf is not None:
             self.pb_wf.set_from_pixbuf(pb_wf)
             self.pb_wf.show()
             self.image.hide()
         self.set_size_request(self.width, self.height)
 
+    def set_shaped (self, shaped):
+        """ Without a shaped window the piece only gets an input window, drawing on its
+        parent, and whoever owns it does the picking. Must be called before realizing. """
+        self.shaped = shaped
+        self.set_visible_window(shaped)
+        self.shape = shaped and self.mask or None
+
     def get_width (self):
         return self.width
 
@@ -113,7 +197,10 @@ class JigsawPiece(Gtk.EventBox):
     def get_position (self):
         # The position relative to the puzzle playing area
         parent = self.get_parent()
-        if parent and parent.get_window():
+        if not self.shaped and isinstance(parent, Gtk.Fixed):
+            # Without a window of our own, the origin would be the parent one
+            self.last_coords = tuple(parent.child_get(self, 'x', 'y'))
+        elif parent and parent.get_window():
             bx,by = parent.get_window().get_origin()[:2]
             px,py = self.get_window().get_origin()[:2]
             self.last_coords = (px-bx,py-by)
@@ -134,6 +221,8 @@ class JigsawPiece(Gtk.EventBox):
 
     def _press_cb (self, w, e, *attrs):
         self.root_coords = e.get_root_coords()
+        self.press_coords = (e.x, e.y)
+        self.motion_stats = [0, 0]
         self.emit('picked')
         
     def _motion_cb (self, w, e, *args):
@@ -144,10 +233,39 @@ class JigsawPiece(Gtk.EventBox):
         dx = curr_root_x - init_root_x
         dy = curr_root_y - init_root_y
         
-        self.emit('moved', dx, dy)
         self.root_coords = (curr_root_x, curr_root_y)
+        self.motion_stats[0] += 1
+        if not COALESCE_MOTION:
+            self._emit_moved(dx, dy)
+            return
+        px, py = self._pending_motion
+        self._pending_motion = (px + dx, py + dy)
+        if self._tick_id is None:
+            self._tick_id = self.add_tick_callback(self._tick_cb)
+
+    def _tick_cb (self, w, frame_clock):
+        self._tick_id = None
+        self._flush_motion()
+        return False
+
+    def _flush_motion (self):
+        """ Emits whatever motion was added up since the last move. """
+        if self._tick_id is not None:
+            self.remove_tick_callback(self._tick_id)
+            self._tick_id = None
+        dx, dy = self._pending_motion
+        self._pending_motion = (0, 0)
+        if dx or dy:
+            self._emit_moved(dx, dy)
+
+    def _emit_moved (self, dx, dy):
+        self.motion_stats[1] += 1
+        self.emit('moved', int(dx), int(dy))
 
     def _release_cb (self, w, e, *args):
+        self._flush_motion()
+        logging.debug("Piece #%s drag: %i motion events, %i moves" % (
+                self.index, self.motion_stats[0], self.motion_stats[1]))
         self.emit('dropped')
         # The actual position in the whole window is w.get_window().get_origin()
 
@@ -234,37 +352,260 @@ class CutterClassic (CutterBasic):
         return size*2
 CUTTERS['classic'] = CutterClassic
 
+class ConnectorHints (object):
+    """ A read only sequence of connector directions, 1 or -1, packed as the bits of one integer. """
+    def __init__ (self, bits, count):
+        self.bits = bits
+        self.count = count
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return (self.bits >> i) & 1 and 1 or -1
+
+    def __iter__ (self):
+        for i in range(self.count):
+            yield self[i]
+
+def make_connector_hints (seed, count):
+    """ Returns the (horizontal, vertical) connector hints for count edges each.
+    The same seed always gives the same hints, so only the seed needs to be stored or sent. """
+    rng = random.Random(seed)
+    return ConnectorHints(rng.getrandbits(count), count), ConnectorHints(rng.getrandbits(count), count)
+
+def append_segments (cairo_ctx, segments):
+    """ Replays a list of (path data type, points) segments, as found when
+    iterating a cairo.Path, onto cairo_ctx. """
+    for kind, points in segments:
+        if kind == cairo.PATH_MOVE_TO:
+            cairo_ctx.move_to(*points)
+        elif kind == cairo.PATH_LINE_TO:
+            cairo_ctx.line_to(*points)
+        elif kind == cairo.PATH_CURVE_TO:
+            cairo_ctx.curve_to(*points)
+
+def reverse_segments (segments):
+    """ Returns the same (path data type, points) segments traversed from the
+    end point back to the start point. """
+    ends = [segments[0][1]] + [points[-2:] for kind, points in segments[1:]]
+    rv = [(cairo.PATH_MOVE_TO, ends[-1])]
+    for i in range(len(segments)-1, 0, -1):
+        kind, points = segments[i]
+        if kind == cairo.PATH_CURVE_TO:
+            rv.append((kind, points[2:4] + points[0:2] + ends[i-1]))
+        else:
+            rv.append((cairo.PATH_LINE_TO, ends[i-1]))
+    return rv
+
+class CutLattice (object):
+    """ The geometry of a board cut in cols x rows pieces.
+    Each edge of the lattice is traced once through the cutter, in board coordinates, and
+    kept as a list of path segments. Vertical edges run upwards from their bottom node and
+    horizontal edges run rightwards from their left node, so each piece is assembled from
+    its four edges, reversing the left and top ones. The overlap of every edge over each of
+    its two pieces is kept alongside, giving the piece bounding boxes without any drawing. """
+    def __init__ (self, cutter, width, height, cols, rows, h_connector_hints, v_connector_hints):
+        self.cutter = cutter
+        self.cols, self.rows = cols, rows
+        self.xs = [float(width)*c/cols for c in range(cols)] + [float(width)]
+        self.ys = [float(height)*r/rows for r in range(rows)] + [float(height)]
+        cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 1, 1))
+        # v_edges[c][r] is the edge on the left of piece (c,r), h_edges[c][r] the one on top.
+        # *_overlap[c][r] is how far (the piece before the edge, the piece after it) reach past it
+        self.v_edges, self.v_overlap = [], []
+        for c in range(cols+1):
+            edges = [self._trace_vertical(cr, c, r, h_connector_hints[r*cols+c]) for r in range(rows)]
+            self.v_edges.append([e[0] for e in edges])
+            self.v_overlap.append([e[1] for e in edges])
+        self.h_edges, self.h_overlap = [], []
+        for c in range(cols):
+            edges = [self._trace_horizontal(cr, c, r, v_connector_hints[c*rows+r]) for r in range(rows+1)]
+            self.h_edges.append([e[0] for e in edges])
+            self.h_overlap.append([e[1] for e in edges])
+
+    def _trace_vertical (self, cr, col, row, ptype):
+        height = self.ys[row+1] - self.ys[row]
+        cr.new_path()
+        cr.move_to(self.xs[col], self.ys[row+1])
+        overlap = (0, 0)
+        if col > 0 and col < self.cols:
+            # Drawn as the right side of the piece on the left
+            point_out = ptype >= 0
+            t1 = height*self.cutter.connector_percent/100.0
+            t2 = t1/2.0
+            cr.rel_line_to(0, -((height/2.0) - t2))
+            t = self.cutter.draw_connector(cr, t1, self.cutter.SIDE_RIGHT, point_out)
+            cr.rel_line_to(0, -((height/2.0) - t2))
+            overlap = point_out and (t, 0) or (0, t)
+        else:
+            cr.rel_line_to(0, -height)
+        return list(cr.copy_path()), overlap
+
+    def _trace_horizontal (self, cr, col, row, ptype):
+        width = self.xs[col+1] - self.xs[col]
+        cr.new_path()
+        cr.move_to(self.xs[col], self.ys[row])
+        overlap = (0, 0)
+        if row > 0 and row < self.rows:
+            # Drawn as the bottom side of the piece above
+            point_out = ptype >= 0
+            t1 = width*self.cutter.connector_percent/100.0
+            t2 = t1/2.0
+            cr.rel_line_to((width/2.0) - t2, 0)
+            t = self.cutter.draw_connector(cr, t1, self.cutter.SIDE_BOTTOM, point_out)
+            cr.rel_line_to((width/2.0) - t2, 0)
+            overlap = point_out and (t, 0) or (0, t)
+        else:
+            cr.rel_line_to(width, 0)
+        return list(cr.copy_path()), overlap
+
+    def get_edges (self):
+        """ Every edge in the lattice, each one once. """
+        for col in self.v_edges:
+            for edge in col:
+                yield edge
+        for col in self.h_edges:
+            for edge in col:
+                yield edge
+
+    def piece_segments (self, x, y):
+        """ The closed outline of piece (x,y): down the left side, along the bottom,
+        up the right side and back along the top. """
+        rv = reverse_segments(self.v_edges[x][y])
+        rv.extend(self.h_edges[x][y+1][1:])
+        rv.extend(self.v_edges[x+1][y][1:])
+        rv.extend(reverse_segments(self.h_edges[x][y])[1:])
+        return rv
+
+    def piece_box (self, x, y):
+        """ The (x0, y0, x1, y1) bounding box of piece (x,y), connectors included. """
+        return (self.xs[x] - self.v_overlap[x][y][1],
+                self.ys[y] - self.h_overlap[x][y][1],
+                self.xs[x+1] + self.v_overlap[x+1][y][0],
+                self.ys[y+1] + self.h_overlap[x][y+1][0])
+
 class CutBoard (object):
     def __init__ (self, *args, **kwargs):
         if len(args) or len(kwargs):
             self._prepare(*args, **kwargs)
         self.cutter = CutterClassic()
         self.pb = None
+        self.atlas = None
+        self._digest = (None, None)
+        self._cut = {}
 
-    def _prepare (self, cols, rows, cutter=None, hch=None, vch=None):
+    def _prepare (self, cols, rows, cutter=None, hch=None, vch=None, seed=None):
         if self.pb is None:
             logging.error("You must fist set CutBoard.pb with a pixbuf to be used!")
             return
         if cutter is not None:
             self.cutter = CUTTERS.get(cutter, CutterClassic)()
         self.rows, self.cols = rows, cols
-        if hch is not None:
+        if hch is not None and vch is not None:
+            # Legacy hint lists, as stored before hint seeds existed
+            self.hint_seed = None
             self.h_connector_hints = hch
-        else:
-            self.h_connector_hints = [random.random()*2-1 for x in range((self.rows+1)*(self.cols+1))]
-        if vch is not None:
             self.v_connector_hints = vch
         else:
-            self.v_connector_hints = [random.random()*2-1 for x in range((self.rows+1)*(self.cols+1))]
+            if seed is None:
+                seed = random.getrandbits(32)
+            self.hint_seed = seed
+            self.h_connector_hints, self.v_connector_hints = make_connector_hints(
+                seed, (self.rows+1)*(self.cols+1))
         self.width, self.height = self.pb.get_width(), self.pb.get_height()
+        self.atlas = None
         self.pm = create_surface(self.width, self.height, self.pb)
         self.cr = cairo.Context(self.pm)
-        self.pieces = []
-        self.prepare_hint()
-        for c in range(self.cols):
-            self.pieces.append([])
-            for r in range(self.rows):
-                self.pieces[c].append(self.cut(c,r))
+        self.lattice = CutLattice(self.cutter, self.width, self.height, self.cols, self.rows,
+                                  self.h_connector_hints, self.v_connector_hints)
+        # Only rendered if the hint is ever shown, see get_hint
+        self.hint = None
+        # The finished cut, for store_cut. A new dict, as copies of the board cutting
+        # the previous cut still fill in the old one.
+        self._cut = {}
+
+    def iter_pieces (self):
+        """ Cuts the pieces on demand, in column major order, as the caller consumes them.
+        At most CUT_LOOKAHEAD pieces are cut ahead of the one being consumed.
+        When CUT_CACHE holds this very cut, the pieces are read back from it instead,
+        into an atlas if CUT_ATLAS is set. A new cut is only kept for store_cut. """
+        if CUT_CACHE is None:
+            for piece in self._iter_cut():
+                yield piece
+            return
+        key = self.get_cache_key()
+        pieces = CUT_CACHE.load(key)
+        if pieces is not None:
+            logging.debug("Cut %s read from cache" % key)
+            self._cut['stored'] = True
+            if CUT_ATLAS:
+                pieces = self.pack_atlas(pieces)
+            for piece in pieces:
+                yield piece
+            return
+        pieces = []
+        for piece in self._iter_cut():
+            pieces.append(piece)
+            yield piece
+        self._cut.update(key=key, pieces=pieces)
+
+    def store_cut (self):
+        """ Writes the last cut, if it was cut to the end, to CUT_CACHE, once.
+        Shuffles get a random hint seed and are almost never cut again, so this is only
+        done when the board is saved or shared, see _freeze, to be cut again from its
+        seed when it is resumed or joined. """
+        cut = self._cut
+        if CUT_CACHE is None or cut.get('stored') or 'pieces' not in cut:
+            return
+        cut['stored'] = True
+        CUT_CACHE.store_async(cut['key'], cut.pop('pieces'))
+
+    def get_cache_key (self):
+        if self._digest[0] is not self.pb:
+            self._digest = (self.pb, image_digest(self.pb))
+        if self.hint_seed is not None:
+            hints = self.hint_seed
+        else:
+            hints = (self.h_connector_hints, self.v_connector_hints)
+        return CUT_CACHE.key(self._digest[1], self.cols, self.rows, self.get_cutter(), hints)
+
+    def _iter_cut (self):
+        workers = self.get_workers()
+        if CUT_ATLAS:
+            # The atlas needs every piece before any can be handed out
+            for piece in self.cut_atlas(workers):
+                yield piece
+            return
+        order = [(c, r) for c in range(self.cols) for r in range(self.rows)]
+        if workers == 1:
+            for c, r in order:
+                yield self.cut(c, r)
+            return
+        lookahead = max(1, CUT_LOOKAHEAD or 2*workers)
+        # The pieces only read from self.pm, so every thread shares the one
+        # board surface. Cairo and GdkPixbuf release the GIL while rendering.
+        pool = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            for c, r in order:
+                pending.append(pool.submit(self.cut, c, r))
+                if len(pending) > lookahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The consumer may stop early, drop whatever was not started yet
+            for f in pending:
+                f.cancel()
+            pool.shutdown()
+
+    def get_workers (self):
+        """ How many threads to cut with, 1 meaning serial cutting on the calling thread. """
+        workers = CUT_WORKERS or os.cpu_count() or 1
+        return max(1, min(workers, self.cols*self.rows))
 
     def get_cutter (self):
         for k,v in list(CUTTERS.items()):
@@ -277,10 +618,16 @@ class CutBoard (object):
             self.cutter = CUTTERS.get(cutter, CutterClassic)()
 
     def prepare_hint (self):
-        self.hint_pm = create_surface(self.width, self.height)
-        self.hint_cr = cairo.Context(self.hint_pm)
-        self.hint_cr.set_source_rgb (0,0,0)
-        self.hint_cr.set_line_width(0.5)
+        """ Strokes the piece outlines on a new surface, in one pass over the lattice. """
+        hint_pm = create_surface(self.width, self.height)
+        hint_cr = cairo.Context(hint_pm)
+        hint_cr.set_source_rgb (0,0,0)
+        hint_cr.set_line_width(0.5)
+        # Every edge is shared by two pieces, stroke each of them only once
+        for edge in self.lattice.get_edges():
+            append_segments(hint_cr, edge)
+        hint_cr.stroke()
+        return hint_pm
 
     def refresh (self):
         if self.cr and self.pb:
@@ -290,95 +637,59 @@ class CutBoard (object):
             self.cr.set_source_rgb(0,0,0)
 
     def get_hint (self):
-        # self.hint_pm must be a cairo.Surface
-        pb = Gdk.pixbuf_get_from_surface(self.hint_pm, 0, 0, self.width, self.height)
-        return pb
-
-    def draw_vertical_path (self, cairo_ctx, piece_nr, col, height, ptype=0):
-        """ returns the number of overlapping pixels on the drawn side """
-        if col > piece_nr:
-            # right_side
-            op = lambda x: -x
-        else:
-            # left_side
-            op = lambda x: x
-        if col > 0 and col < self.cols:
-            point_out = col > piece_nr
-            t1 = height*self.cutter.connector_percent/100.0
-            t2 = t1/2.0
-            if ptype < 0:
-                point_out = not point_out
-            cairo_ctx.rel_line_to(0, op((height/2.0) - t2))
-            t = self.cutter.draw_connector(cairo_ctx, t1, col>piece_nr and self.cutter.SIDE_RIGHT or self.cutter.SIDE_LEFT, point_out)
-            cairo_ctx.rel_line_to(0, op((height/2.0) - t2))
-            if point_out:
-                overlap = t
-            else:
-                overlap = 0
-        else:
-            cairo_ctx.rel_line_to(0, op(height))
-            overlap = 0
-        return overlap
-
-    def draw_horizontal_path (self, cairo_ctx, piece_nr, row, width, ptype=0):
-        """ returns the number of overlapping pixels on the drawn side """
-        # positive or negative connector? We must randomize this.
-        if row > piece_nr:
-            # bottom_side
-            op = lambda x: x
-        else:
-            # top_side
-            op = lambda x: -x
-        if row > 0 and row < self.rows:
-            point_out = row > piece_nr
-            t1 = width*self.cutter.connector_percent/100.0
-            t2 = t1/2.0
-            if ptype < 0:
-                point_out = not point_out
-            cairo_ctx.rel_line_to(op((width/2.0) - t2), 0)
-            t = self.cutter.draw_connector(cairo_ctx, t1, row>piece_nr and self.cutter.SIDE_BOTTOM or self.cutter.SIDE_TOP, point_out)
-            cairo_ctx.rel_line_to(op((width/2.0) - t2), 0)
-            if point_out:
-                overlap = t
-            else:
-                overlap = 0
-        else:
-            cairo_ctx.rel_line_to(op(width),0)
-            overlap = 0
-        return overlap
-
-    def path_for_piece (self, cairo_context, x, y, width, height):
-        hpos = (y*self.cols)+x
-        vpos = (x*self.rows)+y
-        l_offset = self.draw_vertical_path(cairo_context, x, x, height, self.h_connector_hints[hpos])
-        b_offset = self.draw_horizontal_path(cairo_context, y, y+1, width, self.v_connector_hints[vpos+1])
-        r_offset = self.draw_vertical_path(cairo_context, x, x+1, height, self.h_connector_hints[hpos+1])
-        t_offset = self.draw_horizontal_path(cairo_context, y, y, width, self.v_connector_hints[vpos])
-        return {'left':l_offset, 'right': r_offset, 'top': t_offset, 'bottom': b_offset}
+        """ The hint pixbuf, rendered the first time it is asked for and kept until the
+        next cut is prepared. """
+        if self.hint is None:
+            self.hint = Gdk.pixbuf_get_from_surface(self.prepare_hint(), 0, 0, self.width, self.height)
+        return self.hint
+
+    def piece_path (self, x, y):
+        """ Assembles the outline for piece (x,y) from its four lattice edges.
+        Returns the recorded cairo.Path, in board coordinates, to be replayed on any
+        context with append_path. """
+        cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 1, 1))
+        append_segments(cr, self.lattice.piece_segments(x, y))
+        return cr.copy_path()
+
+    def piece_rect (self, x, y):
+        """ Returns (crop_x, crop_y, full_width, full_height, width, height) for piece (x,y):
+        the area it is cut from, connectors included, and its nominal size. """
+        x0, y0, x1, y1 = self.lattice.piece_box(x, y)
+        crop_x = int(x0)
+        crop_y = int(y0)
+        return (crop_x, crop_y, int(math.ceil(x1)) - crop_x, int(math.ceil(y1)) - crop_y,
+                int(self.lattice.xs[x+1] - self.lattice.xs[x]),
+                int(self.lattice.ys[y+1] - self.lattice.ys[y]))
+
+    def get_piece_sizes (self):
+        """ The full (width, height) of every piece, in the order they are cut in. """
+        return [self.piece_rect(c, r)[2:4] for c in range(self.cols) for r in range(self.rows)]
 
     def cut (self, x, y):
-        width = self.width / self.cols
-        height = self.height / self.rows
-        px = width*x
-        py = height*y
-        if x == self.cols - 1:
-            width = self.width - px
-        if y == self.rows - 1:
-            height = self.height - py
+        """ Cuts piece (x,y). Only reads shared state, so it is safe to call
+        from a worker thread. """
+        crop_x, crop_y, full_width, full_height, width, height = self.piece_rect(x, y)
+        mask = cairo.ImageSurface(cairo.FORMAT_A1, full_width, full_height)
+        piece_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, full_width, full_height)
+        outlined_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, full_width, full_height)
+        self.render_piece(x, y, mask, piece_surface, outlined_surface)
+        pb = Gdk.pixbuf_get_from_surface(piece_surface, 0, 0, full_width, full_height)
+        pb_wf = Gdk.pixbuf_get_from_surface(outlined_surface, 0, 0, full_width, full_height)
+        return (pb, pb_wf, mask, crop_x, crop_y, width, height)
 
+    def render_piece (self, x, y, mask, piece_surface, outlined_surface):
+        """ Draws the mask, the piece and the outlined piece for piece (x,y) on the given
+        surfaces, which must be at least as big as its full size and may be sub surfaces. """
         # the cut mask is done on each piece at the right and bottom sides,
         # except for the right on the last column and bottom on the last row.
-
-        # Draw outline on the board hint image
-        self.hint_cr.move_to(px,py)
-        offsets = self.path_for_piece(self.hint_cr, x, y, width, height)
-        self.hint_cr.stroke()
-        width_offset = int(offsets['left'] + offsets['right'])
-        height_offset = int(offsets['top'] + offsets['bottom'])
-        width = int(width)
-        height = int(height)
-        # Prepare the piece mask
-        mask = cairo.ImageSurface(cairo.FORMAT_A1, width + width_offset, height + height_offset)
+        # The outline is assembled once and replayed on every context below.
+        path = self.piece_path(x, y)
+        self.render_mask(x, y, path, mask)
+        self.render_images(x, y, path, mask, piece_surface, outlined_surface)
+
+    def render_mask (self, x, y, path, mask):
+        """ Rasterizes the piece outline path on the A1 mask surface. """
+        crop_x, crop_y = self.piece_rect(x, y)[:2]
         mask_cr = cairo.Context(mask)
         mask_cr.save()
         mask_cr.set_operator(cairo.OPERATOR_SOURCE)
@@ -387,17 +698,14 @@ class CutBoard (object):
         mask_cr.restore()
         mask_cr.set_line_width(1.0)
         mask_cr.set_source_rgba(1,1,1,1)
-        mask_cr.move_to(offsets['left'], offsets['top'])
-        self.path_for_piece(mask_cr, x, y, width, height)
+        mask_cr.translate(-crop_x, -crop_y)
+        mask_cr.append_path(path)
         mask_cr.stroke_preserve()
         mask_cr.fill()
 
-        crop_x = int(px - offsets['left'])
-        crop_y = int(py - offsets['top'])
-        full_width = width + width_offset
-        full_height = height + height_offset
-
-        piece_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, full_width, full_height)
+    def render_images (self, x, y, path, mask, piece_surface, outlined_surface):
+        """ Copies the board image through the mask onto the piece and outlined surfaces. """
+        crop_x, crop_y = self.piece_rect(x, y)[:2]
         piece_cr = cairo.Context(piece_surface)
         piece_cr.set_source_surface(self.pm, -crop_x, -crop_y)
         piece_cr.paint()
@@ -405,10 +713,6 @@ class CutBoard (object):
         piece_cr.set_source_surface(mask, 0, 0)
         piece_cr.paint()
 
-        self.refresh()
-        pb = Gdk.pixbuf_get_from_surface(piece_surface, 0, 0, full_width, full_height)
-
-        outlined_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, full_width, full_height)
         outlined_cr = cairo.Context(outlined_surface)
         outlined_cr.set_source_surface(self.pm, -crop_x, -crop_y)
         outlined_cr.paint()
@@ -418,14 +722,83 @@ class CutBoard (object):
         outlined_cr.set_operator(cairo.OPERATOR_OVER)
         outlined_cr.set_line_width(1.0)
         outlined_cr.set_source_rgb(0, 0, 0)
-        outlined_cr.translate(offsets['left'], offsets['top'])
-        outlined_cr.move_to(0, 0)
-        self.path_for_piece(outlined_cr, x, y, width, height)
+        outlined_cr.translate(-crop_x, -crop_y)
+        outlined_cr.append_path(path)
         outlined_cr.stroke()
 
-        pb_wf = Gdk.pixbuf_get_from_surface(outlined_surface, 0, 0, full_width, full_height)
-
-        return (pb, pb_wf, mask, crop_x, crop_y, width, height)
+    def cut_atlas (self, workers=1):
+        """ Cuts every piece into one atlas instead of a surface and two pixbufs each.
+        The pieces and their outlined version share a single pixbuf, one above the other,
+        and the masks share a single A1 surface. Returns the piece tuples, in column major
+        order, each holding sub pixbufs and a sub surface of the atlas. """
+        order = [(c, r) for c in range(self.cols) for r in range(self.rows)]
+        rects = [self.piece_rect(c, r) for c, r in order]
+        positions, atlas_width, atlas_height = pack_shelves([r[2:4] for r in rects],
+                                                            max(self.width, 1))
+        masks = cairo.ImageSurface(cairo.FORMAT_A1, atlas_width, atlas_height)
+        atlas = cairo.ImageSurface(cairo.FORMAT_ARGB32, atlas_width, atlas_height*2)
+        jobs = []
+        for (c, r), (ax, ay), rect in zip(order, positions, rects):
+            w, h = rect[2:4]
+            jobs.append((c, r,
+                         masks.create_for_rectangle(ax, ay, w, h),
+                         atlas.create_for_rectangle(ax, ay, w, h),
+                         atlas.create_for_rectangle(ax, ay+atlas_height, w, h)))
+        if workers > 1:
+            # The atlas surfaces must only be drawn on from one thread, and pieces next to
+            # each other share words of the A1 masks, so the workers render every piece on
+            # surfaces of its own, copied into the atlas here in order
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for job, parts in zip(jobs, pool.map(self._render_apart, jobs)):
+                    for target, source in zip(job[2:], parts):
+                        copy_surface(target, source)
+        else:
+            for job in jobs:
+                self.render_piece(*job)
+        atlas.flush()
+        atlas_pb = Gdk.pixbuf_get_from_surface(atlas, 0, 0, atlas_width, atlas_height*2)
+        self.atlas = (atlas_pb, masks)
+        rv = []
+        for job, (ax, ay), rect in zip(jobs, positions, rects):
+            crop_x, crop_y, w, h, width, height = rect
+            rv.append((atlas_pb.new_subpixbuf(ax, ay, w, h),
+                       atlas_pb.new_subpixbuf(ax, ay+atlas_height, w, h),
+                       job[2], crop_x, crop_y, width, height))
+        return rv
+
+    def pack_atlas (self, pieces):
+        """ Copies piece tuples, as read back from CUT_CACHE, into an atlas laid out the
+        way cut_atlas lays it out. Returns the piece tuples, holding sub pixbufs and a sub
+        surface of the atlas. """
+        sizes = [(p[0].get_width(), p[0].get_height()) for p in pieces]
+        positions, atlas_width, atlas_height = pack_shelves(sizes, max(self.width, 1))
+        masks = cairo.ImageSurface(cairo.FORMAT_A1, atlas_width, atlas_height)
+        atlas_pb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                        atlas_width, atlas_height*2)
+        atlas_pb.fill(0)
+        rv = []
+        for (pb, pb_wf, mask, px, py, pw, ph), (ax, ay), (w, h) in zip(pieces, positions, sizes):
+            pb.copy_area(0, 0, w, h, atlas_pb, ax, ay)
+            pb_wf.copy_area(0, 0, w, h, atlas_pb, ax, ay+atlas_height)
+            sub_mask = masks.create_for_rectangle(ax, ay, w, h)
+            copy_surface(sub_mask, mask)
+            rv.append((atlas_pb.new_subpixbuf(ax, ay, w, h),
+                       atlas_pb.new_subpixbuf(ax, ay+atlas_height, w, h),
+                       sub_mask, px, py, pw, ph))
+        masks.flush()
+        self.atlas = (atlas_pb, masks)
+        return rv
+
+    def _render_apart (self, job):
+        """ Renders the piece of a cut_atlas job on new mask, piece and outlined surfaces
+        the size of the job ones, and returns them. """
+        c, r, mask, piece_surface, outlined_surface = job
+        w, h = self.piece_rect(c, r)[2:4]
+        parts = (cairo.ImageSurface(cairo.FORMAT_A1, w, h),
+                 cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h),
+                 cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h))
+        self.render_piece(c, r, *parts)
+        return parts
 
     def get_image_as_png (self, cb=None):
         if self.pb is None:
@@ -443,20 +816,25 @@ class CutBoard (object):
 
     def _freeze (self, img_cksum_only=False):
         if self.pb is not None:
+            # Saved or shared, so it may well be cut again
+            self.store_cut()
             if img_cksum_only:
                 cksum = hashlib.md5()
                 self.get_image_as_png(cksum.update)
-                return {'geom': (self.cols, self.rows),
-                        'hints': (self.h_connector_hints, self.v_connector_hints),
-                        'pb-cksum': cksum.hexdigest(),
-                        'cutter': self.get_cutter(),
-                        }
+                rv = {'geom': (self.cols, self.rows),
+                      'pb-cksum': cksum.hexdigest(),
+                      'cutter': self.get_cutter(),
+                      }
             else:
-                return {'geom': (self.cols, self.rows),
-                        'hints': (self.h_connector_hints, self.v_connector_hints),
-                        'pb': self.get_image_as_png(),
-                        'cutter': self.get_cutter(),
-                        }
+                rv = {'geom': (self.cols, self.rows),
+                      'pb': self.get_image_as_png(),
+                      'cutter': self.get_cutter(),
+                      }
+            if self.hint_seed is not None:
+                rv['hint-seed'] = self.hint_seed
+            else:
+                rv['hints'] = (list(self.h_connector_hints), list(self.v_connector_hints))
+            return rv
         return None
 
     def _thaw (self, data):
@@ -474,15 +852,467 @@ class CutBoard (object):
             del data['pb']
         logging.debug("cutboard._thaw(%s)" % str(data))
         cols, rows = data['geom']
-        hch, vch = data['hints']
+        hch, vch = data.get('hints', (None, None))
         cutter = data['cutter']
-        self._prepare(cols, rows, cutter, hch, vch)
+        self._prepare(cols, rows, cutter, hch, vch, data.get('hint-seed', None))
+
+
+class PieceClusters (object):
+    """ Union-find over piece indices, tracking which pieces were joined together.
+    The members of every cluster are kept on its root, merging the smaller list
+    into the larger one. """
+    def __init__ (self, count):
+        self.parent = list(range(count))
+        self.members = [[i] for i in range(count)]
+
+    def find (self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union (self, a, b):
+        """ Joins the clusters of a and b, returns the root of the result. """
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if len(self.members[a]) < len(self.members[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.members[a].extend(self.members[b])
+        self.members[b] = None
+        return a
+
+    def get_members (self, i):
+        return self.members[self.find(i)]
+
+
+class CutJob (object):
+    """ Cuts a board on a worker thread.
+    The job cuts from its own copy of the CutBoard, so preparing a new cut does not
+    disturb it, and hands every piece tuple to deliver on the main loop, then calls done.
+    At most CUT_LOOKAHEAD pieces are waiting for the main loop at any time, the cutting
+    stalls until it catches up. Once cancelled, nothing more is handed over and the
+    cutting stops. """
+    def __init__ (self, cutboard, deliver, done=None):
+        self.cutboard = copy.copy(cutboard)
+        self.deliver = deliver
+        self.done = done
+        self.cancelled = False
+        self.delivered = 0
+        self._thread = None
+        lookahead = CUT_LOOKAHEAD or 2*self.cutboard.get_workers()
+        self._slots = threading.Semaphore(max(1, lookahead))
+
+    def start (self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel (self):
+        self.cancelled = True
+
+    def finish (self):
+        """ Cancels the job and cuts the pieces it did not deliver yet on the calling
+        thread, which must be the main loop one. Returns them in the order they are cut in. """
+        self.cancel()
+        board = self.cutboard
+        order = [(c, r) for c in range(board.cols) for r in range(board.rows)]
+        return [board.cut(c, r) for c, r in order[self.delivered:]]
+
+    def _run (self):
+        pieces = self.cutboard.iter_pieces()
+        try:
+            for data in pieces:
+                self._slots.acquire()
+                if self.cancelled:
+                    break
+                GLib.idle_add(self._deliver, data)
+        except Exception:
+            logging.exception("Cutting the board failed")
+        finally:
+            pieces.close()
+        GLib.idle_add(self._done)
+
+    def _deliver (self, data):
+        try:
+            if not self.cancelled:
+                self.delivered += 1
+                self.deliver(data)
+        finally:
+            self._slots.release()
+        return False
+
+    def _done (self):
+        if not self.cancelled and self.done is not None:
+            self.done()
+        return False
+
+
+class PieceState (object):
+    """ The state of every piece of a cut, kept as parallel arrays indexed by piece index:
+    where it is (x, y), where it belongs on the board image (tx, ty), how close to its
+    place it has to be dropped (mx, my), whether it is placed and its stacking order (z).
+    pieces maps the indices to the piece objects, None until a piece is cut. """
+    def __init__ (self, count=0):
+        self.count = count
+        self.x = array('i', [0]) * count
+        self.y = array('i', [0]) * count
+        self.tx = array('i', [0]) * count
+        self.ty = array('i', [0]) * count
+        self.mx = array('d', [0.0]) * count
+        self.my = array('d', [0.0]) * count
+        self.placed = array('b', [0]) * count
+        self.z = array('l', [0]) * count
+        self.pieces = [None] * count
+        self.added = 0
+        self.remaining = count
+        self._z = 0
+
+    def add (self, tx, ty, mx, my):
+        """ Adds the next piece, in the order pieces are cut in. Returns its index. """
+        index = self.added
+        self.added += 1
+        self.tx[index], self.ty[index] = tx, ty
+        self.mx[index], self.my[index] = mx, my
+        return index
+
+    def move (self, index, x, y):
+        self.x[index], self.y[index] = int(x), int(y)
+
+    def get_position (self, index):
+        return (self.x[index], self.y[index])
+
+    def raise_to_top (self, index):
+        self._z += 1
+        self.z[index] = self._z
+
+    def is_floating (self, index):
+        return self.pieces[index] is not None and not self.placed[index]
+
+    def get_floating (self):
+        """ The indices of the floating pieces, bottom to top. """
+        rv = [i for i in range(self.added) if not self.placed[i]]
+        rv.sort(key=self.z.__getitem__)
+        return rv
+
+    def set_placed (self, index):
+        """ Marks piece index as placed. Returns True if no piece is missing any more. """
+        if not self.placed[index]:
+            self.placed[index] = 1
+            self.remaining -= 1
+        return self.remaining == 0
+
+
+class BoardModel (object):
+    """ The board state shared by every play surface: the cut board, where each piece
+    belongs and which pieces are still missing. Mixed into the board widgets, which
+    must provide img_width and img_height once an image is set. """
+    def _init_model (self):
+        self.state = PieceState()
+        self.clusters = None
+        self.target_pieces_per_line = 3
+        self.cutboard = CutBoard()
+
+    def get_cutter (self):
+        return self.cutboard.get_cutter()
+
+    def set_cutter (self, cutter):
+        self.cutboard.set_cutter(cutter)
+
+    def get_grid (self):
+        """ Find the best cut for our difficulty level, returns (cols, rows) """
+        pcw = self.target_pieces_per_line
+        pch = self.target_pieces_per_line
+        changed = True
+        while changed:
+            pw = self.img_width / pcw
+            ph = self.img_height / pch
+            changed = False
+            if pcw == 1 or pch == 1:
+                break
+            if abs((self.img_width / (pcw-1))-ph) < abs(pw-ph):
+                pcw -= 1
+                changed = True
+                continue
+            if abs((self.img_height / (pch-1))-pw) < abs(ph-pw):
+                pch -= 1
+                changed = True
+        return pcw, pch
+
+    def prepare_cut (self, reshuffle=True):
+        """ Resets the piece state and, if reshuffle is set, prepares a new cut.
+        Returns False if there is no image to cut. """
+        if self.cutboard.pb is None:
+            return False
+        if reshuffle:
+            pcw, pch = self.get_grid()
+            logging.debug("Board matrix %s %s" % (pcw, pch))
+            self.cutboard._prepare(pcw, pch)
+        self.state = PieceState(self.get_piece_count())
+        self.clusters = PieceClusters(self.get_piece_count())
+        return True
+
+    def add_piece_data (self, data):
+        """ Records where a piece, as cut by CutBoard.iter_pieces, belongs on the board.
+        Pieces must be added in the order they are cut in. Returns the piece index.
+        The board widget must set the piece it makes in state.pieces. """
+        pb, pb_wf, mask, px, py, pw, ph = data
+        return self.state.add(px, py, pw*MAGNET_POWER_PERCENT/100.0, ph*MAGNET_POWER_PERCENT/100.0)
+
+    def get_piece_count (self):
+        return self.cutboard.cols*self.cutboard.rows
+
+    def get_piece (self, index):
+        """ The piece of the given index, None if there is none (yet). """
+        if 0 <= index < self.state.count:
+            return self.state.pieces[index]
+        return None
+
+    def get_target (self, index):
+        """ The (x, y) position piece index belongs at, relative to the board image. """
+        return (self.state.tx[index], self.state.ty[index])
+
+    def fits (self, index, x, y):
+        """ Tests if piece index, dropped at x,y relative to the board image,
+        is close enough to its place to be magnetized there. """
+        state = self.state
+        bx, by = state.tx[index], state.ty[index]
+        logging.debug("Board drop for piece #%i (%i,%i) : (%i,%i)" % (index, x,y,bx,by))
+        return abs(bx-x) < state.mx[index] and abs(by-y) < state.my[index]
+
+    def get_cluster (self, piece):
+        """ Every piece joined to piece, itself included. """
+        if self.clusters is None:
+            return [piece]
+        return [self.state.pieces[i] for i in self.clusters.get_members(piece.get_index())]
+
+    def get_neighbours (self, index):
+        """ The indices of the pieces sharing an edge with piece index. """
+        rows = self.cutboard.rows
+        c, r = divmod(index, rows)
+        if c > 0:
+            yield index - rows
+        if c < self.cutboard.cols - 1:
+            yield index + rows
+        if r > 0:
+            yield index - 1
+        if r < rows - 1:
+            yield index + 1
+
+    def _iter_offsets (self, index):
+        """ Yields (neighbour, dx, dy) for the floating neighbours of the cluster of piece
+        index, dx,dy being how far the cluster is from where it belongs next to them.
+        Takes time linear in the cluster size, whatever the size of the board. """
+        state = self.state
+        root = self.clusters.find(index)
+        for m in self.clusters.get_members(index):
+            if not state.is_floating(m):
+                continue
+            for n in self.get_neighbours(m):
+                if not state.is_floating(n) or self.clusters.find(n) == root:
+                    continue
+                yield (n, state.x[n] - state.tx[n] + state.tx[m] - state.x[m],
+                       state.y[n] - state.ty[n] + state.ty[m] - state.y[m])
+
+    def find_snap (self, index):
+        """ Looks for a floating neighbour the cluster of piece index was dropped close
+        enough to, as fits does for the board. Returns the (dx, dy) to move the cluster
+        by to line up with it, or None. """
+        if self.clusters is None:
+            return None
+        for n, dx, dy in self._iter_offsets(index):
+            if abs(dx) < self.state.mx[n] and abs(dy) < self.state.my[n]:
+                return dx, dy
+        return None
+
+    def join_aligned (self, index, tolerance=1):
+        """ Joins the cluster of piece index with every neighbouring cluster lined up
+        with it within tolerance pixels. Returns the roots the joined clusters had,
+        an empty list if nothing was joined. """
+        if self.clusters is None:
+            return []
+        joined = [n for n, dx, dy in self._iter_offsets(index)
+                  if abs(dx) <= tolerance and abs(dy) <= tolerance]
+        if not joined:
+            return []
+        roots = set([self.clusters.find(n) for n in joined])
+        roots.add(self.clusters.find(index))
+        for n in joined:
+            self.clusters.union(index, n)
+        return list(roots)
+
+    def get_unplaced_clusters (self, pieces):
+        """ The pieces, and every piece joined to them, that are not placed yet, each once. """
+        seen = set()
+        rv = []
+        for piece in pieces:
+            for p in self.get_cluster(piece):
+                index = p.get_index()
+                if not self.state.placed[index] and index not in seen:
+                    seen.add(index)
+                    rv.append(p)
+        return rv
+
+    def set_placed (self, index):
+        """ Marks piece index as placed. Returns True if that solved the puzzle. """
+        return self.state.set_placed(index)
+
+    def get_positions (self):
+        """ Where every cut piece is, None for the placed ones, as saved by _freeze. """
+        state = self.state
+        rv = []
+        for i in range(state.added):
+            if state.placed[i]:
+                rv.append(None)
+            else:
+                rv.append(state.get_position(i))
+        return rv
+
+    def _freeze (self, img_cksum_only=False):
+        return {'target_pieces_per_line': self.target_pieces_per_line,
+                'cutboard': self.cutboard and self.cutboard._freeze(img_cksum_only) or None,
+                }
+
+    def _thaw (self, data):
+        for k in ('target_pieces_per_line', ):
+            if k in data:
+                setattr(self, k, data[k])
+        self.cutboard._thaw(data['cutboard'])
+
+
+class CutSurface (object):
+    """ Cutting the board for a play surface: scaling the image to the surface, laying
+    the pieces out, cutting them, in the background if CUT_IN_BACKGROUND is set, and
+    putting each one where it was saved or scattered around as it comes.
+    Mixed into the play surfaces, which must provide board, a BoardModel, and
+    get_board_rect, get_floating_pieces and bring_to_top, along with _clear_pieces to
+    drop the pieces of the previous cut and _put_floating to put a new piece at x,y.
+    They emit cut-progress and cut-done. """
+    def _init_cut (self):
+        self.running = False
+        self.forced_location = False
+        self._forced = None
+        self._layout = None
+        self._to_place = []
+        self.cut_job = None
+
+    def _init_piece (self, piece):
+        """ Sets up a piece just cut, before it is put anywhere. """
+        pass
+
+    def prepare_image (self, pixbuf=None, reshuffle=True):
+        alloc = self.get_allocation()
+        w, h = alloc.width, alloc.height
+        if pixbuf is not None:
+            factor = min((float(w)*0.6)/pixbuf.get_width(), (float(h)*0.6)/pixbuf.get_height())
+            pixbuf = utils.scale_pixbuf(pixbuf, pixbuf.get_width() * factor,
+                                        pixbuf.get_height()*factor)
+        if pixbuf is None:
+            pixbuf = self.board.cutboard.pb
+        if pixbuf is None:
+            return False
+        self.board.set_image(pixbuf)
+        self._clear_pieces()
+        self._forced = self.forced_location
+        self.forced_location = None
+        self._to_place = []
+        if self.cut_job is not None:
+            # A newer cut supersedes whatever is still being cut
+            self.cut_job.cancel()
+            self.cut_job = None
+        if not self.board.start_pieces(reshuffle):
+            return False
+        # Lay every piece out before any is cut, seeded like the cut itself
+        cutboard = self.board.cutboard
+        self._layout = scatter(cutboard.get_piece_sizes(), (w, h), self.get_board_rect(),
+                               cutboard.hint_seed)
+        self.running = True
+        self.queue_draw()
+        if CUT_IN_BACKGROUND:
+            self.cut_job = CutJob(cutboard, self._add_piece, self._cut_done)
+            self.cut_job.start()
+            return True
+        for data in cutboard.iter_pieces():
+            self._add_piece(data)
+        self._cut_done()
+        return True
+
+    def _add_piece (self, data):
+        """ Adds a freshly cut piece to the game, where it was saved or scattered around. """
+        piece = self.board.add_piece(data)
+        n = piece.get_index()
+        self._init_piece(piece)
+        forced = self._forced
+        if forced and len(forced)>n:
+            xy = forced[n]
+        else:
+            xy = self._layout[n]
+        if xy is None:
+            # Placed along with all the others once everything is cut
+            self._to_place.append(n)
+        else:
+            self._put_floating(piece, *xy)
+        self.emit('cut-progress', n+1, self.board.get_piece_count())
+
+    def _cut_done (self):
+        self.cut_job = None
+        if self._to_place:
+            self.place_pieces(self._to_place)
+            self._to_place = []
+        if self._forced:
+            # Pieces saved lined up with each other were joined together
+            for piece in self.get_floating_pieces():
+                if self.board.join_aligned(piece.get_index()):
+                    self.bring_to_top(piece)
+        self._forced = None
+        self.emit('cut-done')
+
+    def finish_cut (self):
+        """ Adds every piece the running cut did not hand over yet, right away, so the
+        whole board is there to be solved or saved. """
+        job = self.cut_job
+        if job is None:
+            return
+        for data in job.finish():
+            self._add_piece(data)
+        self._cut_done()
+
+    def is_cutting (self):
+        return self.cut_job is not None
+
+    def is_running (self):
+        return self.running
+
+    def solve (self):
+        self.finish_cut()
+        self.board.place_pieces(self.get_floating_pieces())
+
+    def place_pieces (self, indices):
+        """ Places the pieces of the given indices, and those joined to them, in one go. """
+        self.board.place_pieces([self.board.get_piece(i) for i in indices])
+
+    def _freeze (self, img_cksum_only=False):
+        self.finish_cut()
+        return {'board': self.board._freeze(img_cksum_only),
+                'cutter': self.get_cutter(),
+                'target_pieces_per_line': self.get_target_pieces_per_line(),
+                'piece_pos': self.board.get_positions()}
+
+    def _thaw (self, data):
+        if 'board' in data:
+            self.board._thaw(data['board'])
+        self.set_cutter(data.get('cutter', None))
+        self.set_target_pieces_per_line(data.get('target_pieces_per_line', None))
+        self.forced_location = data.get('piece_pos', None)
 
 
-class JigsawBoard (BorderFrame):
+class JigsawBoard (BorderFrame, BoardModel):
     """ Drop area for jigsaw pieces to be tested against.
     Maybe use this to do the piece cutting / hint ? """
     __gsignals__ = {'solved' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
+                    'placed' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (object,)),
                     }
     def __init__ (self):
         super(JigsawBoard, self).__init__(border_color="#0000FF")
@@ -490,23 +1320,18 @@ class JigsawBoard (BorderFrame):
         self.board = Gtk.Fixed()
         self.board.show()
         self.add(self.board)
-        self.board_distribution = None
-        self.target_pieces_per_line = 3
+        self._init_model()
         self.hint_board_image = Gtk.Image()
-        self.cutboard = CutBoard()
+        self._hint_ready = False
 
-    def get_cutter (self):
-        return self.cutboard.get_cutter()
-
-    def set_cutter (self, cutter):
-        self.cutboard.set_cutter(cutter)
-        
     def update_hint (self):
-        self.hint_board_image.set_from_pixmap(self.hint_board, None)
+        """ Shows the hint of the current cut, rendering it if it was not yet. """
+        if not self._hint_ready:
+            self.hint_board_image.set_from_pixbuf(self.cutboard.get_hint())
+            self._hint_ready = True
 
     def set_image (self, pixbuf):
         self.board.foreach(self.board.remove)
-        self.board_distribution = None
         self.board.put(self.hint_board_image, 0,0)
         self.img_width = pixbuf.get_width()
         self.img_height = pixbuf.get_height()
@@ -518,90 +1343,79 @@ class JigsawBoard (BorderFrame):
     #    self.cutboard._prepare(self.target_pieces_per_line,self.target_pieces_per_line)#, self.cutter)
 
     def get_pieces (self, reshuffle=True):
-        if self.cutboard.pb is None:
+        if not self.start_pieces(reshuffle):
             return
-        self.board_distribution = []
-        pcw = self.target_pieces_per_line
-        pch = self.target_pieces_per_line
-        # Find the best cut for our difficulty level
-        changed = True
-        while changed:
-            pw = self.img_width / pcw
-            ph = self.img_height / pch
-            changed = False
-            if pcw == 1 or pch == 1:
-                break
-            if abs((self.img_width / (pcw-1))-ph) < abs(pw-ph):
-                pcw -= 1
-                changed = True
-                continue
-            if abs((self.img_height / (pch-1))-pw) < abs(ph-pw):
-                pch -= 1
-                changed = True
+        # Each piece is only cut when the caller asks for it
+        for data in self.cutboard.iter_pieces():
+            yield self.add_piece(data)
+
+    def start_pieces (self, reshuffle=True):
+        """ Prepares the cut, before any piece is added. The hint is only rendered
+        once it is shown. Returns False if there is no image to cut. """
+        if not self.prepare_cut(reshuffle):
+            return False
+        self.hint_board_image.clear()
+        self._hint_ready = False
+        if self.hint_board_image.get_visible():
+            self.update_hint()
+        return True
 
-        logging.debug("Board matrix %s %s" % (pcw, pch))
-        if reshuffle:
-            self.cutboard._prepare(pcw, pch)
-        # Prepare the pieces
-        self.hint_board_image.set_from_pixbuf(self.cutboard.get_hint())
-
-        pos_x = 0
-        for col in range(pcw):
-            pos_y = 0
-            for row in range(pch):
-                piece = JigsawPiece()
-                pb, pb_wf, mask, px, py, pw, ph = self.cutboard.pieces[col][row]
-                piece.set_from_pixbuf(pb, pb_wf, mask)
-                piece.show()
-                piece.set_index(len(self.board_distribution))
-                self.board_distribution.append((px, py, pw*MAGNET_POWER_PERCENT/100.0, ph*MAGNET_POWER_PERCENT/100.0))
-                yield piece
+    def add_piece (self, data):
+        """ Makes the piece for a piece tuple, as cut by CutBoard.iter_pieces. """
+        pb, pb_wf, mask, px, py, pw, ph = data
+        index = self.add_piece_data(data)
+        piece = JigsawPiece()
+        piece.set_from_pixbuf(pb, pb_wf, mask)
+        piece.show()
+        piece.set_index(index)
+        self.state.pieces[index] = piece
+        return piece
 
     def get_placed_pieces (self):
         return [x for x in self.board.get_children() if isinstance(x, JigsawPiece)]
 
     def place_piece (self, piece):
-        piece.placed = True
-        index = piece.get_index()
-        piece.reparent(self.board)
-        #piece.hide_wireframe()
-        bx, by, mx, my = self.board_distribution[index]
-        self.board.move(piece, bx, by)
-        self.board_distribution[index] = None
-        if len([_f for _f in self.board_distribution if _f])==0:
+        """ Places piece on the board, along with every piece joined to it. """
+        self.place_pieces([piece])
+
+    def place_pieces (self, pieces):
+        """ Places all pieces on the board, along with every piece joined to them,
+        emitting solved at most once. """
+        solved = False
+        self.board.freeze_child_notify()
+        for p in self.get_unplaced_clusters(pieces):
+            p.placed = True
+            index = p.get_index()
+            solved = self.set_placed(index) or solved
+            parent = p.get_parent()
+            if parent is not None:
+                parent.remove(p)
+            #piece.hide_wireframe()
+            self.board.put(p, *self.get_target(index))
+            self.emit('placed', p)
+        self.board.thaw_child_notify()
+        if solved:
             for p in self.board.get_children():
                 if isinstance(p, JigsawPiece):
                     p.hide_wireframe()
             self.emit('solved')
 
     def drop_piece (self, piece, x, y):
-        index = piece.get_index()
-        bx, by, mx, my = self.board_distribution[index]
         x -= self.padding[0]
         y -= self.padding[1]
-        logging.debug("Board drop for piece #%i (%i,%i) : (%i,%i)" % (index, x,y,bx,by))
-        if abs(bx-x) < mx and abs(by-y) < my:
+        if self.fits(piece.get_index(), x, y):
             # We have a positive positioning
             self.place_piece(piece)
-
-    def _freeze (self, img_cksum_only=False):
-        return {'target_pieces_per_line': self.target_pieces_per_line,
-                'cutboard': self.cutboard and self.cutboard._freeze(img_cksum_only) or None,
-                }
-
-    def _thaw (self, data):
-        for k in ('target_pieces_per_line', ):
-            if k in data:
-                setattr(self, k, data[k])
-        self.cutboard._thaw(data['cutboard'])
             
 
-class JigsawPuzzleWidget (Gtk.EventBox):
+class JigsawPuzzleWidget (Gtk.EventBox, CutSurface):
     __gsignals__ = {
         'picked' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (JigsawPiece,)),
         'dropped' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (JigsawPiece,bool)),
         'solved' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
         'cutter-changed' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (str, int)),
+        'cut-progress' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, (int, int)),
+        'cut-done' : (GObject.SignalFlags.RUN_LAST, GObject.TYPE_NONE, ()),
         }
     def __init__ (self):
         super(JigsawPuzzleWidget, self).__init__()
@@ -609,25 +1423,106 @@ class JigsawPuzzleWidget (Gtk.EventBox):
         self.add(self._container)
         self.board = JigsawBoard()
         self.board.connect('solved', self._solved_cb)
+        self.board.connect('placed', self._placed_cb)
         self.board.show()
         self._container.put(self.board, 10, 10)
         self._container.show_all()
-        self.running = False
-        self.forced_location = False
+        self._init_cut()
+        self.pick_index = PICK_INDEX and PickIndex() or None
+        # Pieces dragged to where the board state has them, not yet moved to in the container
+        self._dragged = set()
+        # (piece, bounds) cached when a drag starts, see _cluster_bounds
+        self._drag_bounds = None
+        self.repaint_stats = RepaintStats()
+        self.connect('draw', self._count_draw_cb)
+        # The piece each pressed piece window is dragging, which differs when the
+        # press fell on a transparent area above another piece
+        self._grabbed = {}
 
     def bring_to_top (self, piece):
-        wx,wy = self._container.child_get(piece, 'x', 'y')
-        self._container.remove(piece)
-        self._container.put(piece, wx, wy)
+        """ Raises piece and every piece joined to it, piece last. """
+        cluster = [p for p in self.board.get_cluster(piece) if p is not piece] + [piece]
+        for p in cluster:
+            if p.get_parent() is not self._container:
+                continue
+            wx,wy = self._piece_xy(p)
+            self._container.remove(p)
+            self._container.put(p, wx, wy)
+            self._dragged.discard(p)
+            self.board.state.raise_to_top(p.get_index())
+            if self.pick_index is not None and p in self.pick_index:
+                self.pick_index.raise_to_top(p)
+
+    def _piece_xy (self, piece):
+        """ Where piece is in the container, counting drag moves not committed yet. """
+        return self.board.state.get_position(piece.get_index())
+
+    def _put_piece (self, piece, x, y):
+        """ Adds piece to the container at x,y, above every other floating piece. """
+        self._container.put(piece, x, y)
+        self.board.state.move(piece.get_index(), x, y)
+        self.board.state.raise_to_top(piece.get_index())
+
+    def _set_piece_xy (self, piece, x, y):
+        self.board.state.move(piece.get_index(), x, y)
+        x, y = self._piece_xy(piece)
+        if not DRAG_DAMAGE_ONLY or not piece.get_realized():
+            self._container.move(piece, x, y)
+            return
+        # Reallocating the piece alone moves it without a relayout of the container,
+        # only the area it leaves and the one it covers get repainted
+        self._dragged.add(piece)
+        ca = self._container.get_allocation()
+        old = piece.get_allocation()
+        new = Gdk.Rectangle()
+        new.x, new.y = ca.x + x, ca.y + y
+        new.width, new.height = old.width, old.height
+        self.queue_draw_area(old.x, old.y, old.width, old.height)
+        piece.size_allocate(new)
+        self.queue_draw_area(new.x, new.y, new.width, new.height)
+
+    def _commit_drag (self):
+        """ Moves the dragged pieces in the container to where they were dragged to. """
+        for piece in self._dragged:
+            if piece.get_parent() is self._container:
+                self._container.move(piece, *self._piece_xy(piece))
+        self._dragged = set()
+
+    def move_cluster (self, piece, dx, dy):
+        """ Moves piece and every piece joined to it by dx,dy.
+        Every piece here is a widget of its own, so a cluster costs one move per piece
+        and frame; only JigsawCanvas draws a cluster from a single composite. """
+        for p in self.board.get_cluster(piece):
+            if p.get_parent() is not self._container:
+                continue
+            wx,wy = self._piece_xy(p)
+            self._set_piece_xy(p, wx+dx, wy+dy)
+            if self.pick_index is not None and p in self.pick_index:
+                self.pick_index.move(p, wx+dx, wy+dy)
 
     def show_hint (self, show):
         if show:
+            self.board.update_hint()
             self.board.hint_board_image.show()
         else:
             self.board.hint_board_image.hide()
 
     def get_floating_pieces (self):
-        return [x for x in self._container.get_children() if isinstance(x, JigsawPiece)]
+        """ The floating pieces, bottom to top. """
+        state = self.board.state
+        return [state.pieces[i] for i in state.get_floating()
+                if state.pieces[i].get_parent() is self._container]
+
+    def get_floating_piece (self, index):
+        """ The floating piece of the given index, None if it is placed or not cut yet. """
+        piece = self.board.get_piece(index)
+        if piece is None or piece.get_parent() is not self._container:
+            return None
+        return piece
+
+    def get_piece_position (self, piece):
+        """ Where floating piece is in the play area. """
+        return self._piece_xy(piece)
 
     def set_cutter (self, cutter):
         if cutter is None:
@@ -648,93 +1543,112 @@ class JigsawPuzzleWidget (Gtk.EventBox):
     def get_target_pieces_per_line (self):
         return self.board.target_pieces_per_line
 
-    def prepare_image (self, pixbuf=None, reshuffle=True):
-        alloc = self.get_allocation()
-        x, y, w, h = alloc.x, alloc.y, alloc.width, alloc.height
-        if pixbuf is not None:
-            factor = min((float(w)*0.6)/pixbuf.get_width(), (float(h)*0.6)/pixbuf.get_height())
-            pixbuf = pixbuf.scale_simple(int(pixbuf.get_width() * factor),
-                                         int(pixbuf.get_height()*factor),
-                                         GdkPixbuf.InterpType.BILINEAR)
-        if pixbuf is None:
-            pixbuf = self.board.cutboard.pb
-        if pixbuf is None:
-            return False
-        self.board.set_image(pixbuf)
+    def get_board_rect (self):
+        """ The board area, border included, in container coordinates. """
+        bx, by = self._container.child_get(self.board, 'x', 'y')
+        bw, bh = self.board.inner.get_size_request()
+        return (bx, by, bw, bh)
 
+    def _clear_pieces (self):
         for child in self._container.get_children():
             if child is not self.board:
                 self._container.remove(child)
-        bx, by = self._container.child_get(self.board, 'x', 'y')
-        bw, bh = self.board.inner.get_size_request()
-        br = Gdk.Rectangle()
-        br.x = bx
-        br.y = by
-        br.width = bw
-        br.height = bh
-        for n, piece in enumerate(self.board.get_pieces(reshuffle)):
-            if self.forced_location and len(self.forced_location)>n:
-                if self.forced_location[n] is None:
-                    # Will be placed in the correct place later
-                    self._container.put(piece, 0, 0)
-                else:
-                    self._container.put(piece, *self.forced_location[n])
-            else:
-                pw,ph = piece.get_size_request()
-                r = Gdk.Rectangle(bx,by,pw,ph)
-                r.x = int(random.random()*(w-pw))
-                r.y = int(random.random()*(h-ph))
-                success, inter = br.intersect(r)
-                if success and inter.width > 0:
-                    r.x = int(random.random() * (w - pw))
-                    r.y = int(random.random() * (h - ph))
-                self._container.put(piece, r.x, r.y)
-            piece.connect('picked', self._pick_cb)
-            piece.connect('moved', self._move_cb)
-            piece.connect('dropped', self._drop_cb)
-            if self.forced_location and len(self.forced_location)>n and self.forced_location[n] is None:
-                self.board.place_piece(piece)
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            piece.get_position()
-        self.forced_location = None
-        self.running = True
-        return True
-
-    def is_running (self):
-        return self.running
-
-    def solve (self):
-        for p in [x for x in self._container.get_children() if isinstance(x, JigsawPiece)]:
-            self.board.place_piece(p)
+        if self.pick_index is not None:
+            self.pick_index.clear()
+        self._grabbed = {}
+        self._dragged = set()
+        self._drag_bounds = None
+
+    def _init_piece (self, piece):
+        if self.pick_index is not None:
+            piece.set_shaped(False)
+        piece.connect('picked', self._pick_cb)
+        piece.connect('moved', self._move_cb)
+        piece.connect('dropped', self._drop_cb)
+
+    def _put_floating (self, piece, x, y):
+        self._put_piece(piece, x, y)
+        if self.pick_index is not None:
+            self.pick_index.add(piece, *self._piece_xy(piece), mask=piece.mask)
 
     def _solved_cb (self, *args):
         self.emit('solved')
 
+    def _count_draw_cb (self, w, cr):
+        self.repaint_stats.add(cr)
+        return False
+
+    def _placed_cb (self, board, piece):
+        self._dragged.discard(piece)
+        if self.pick_index is not None:
+            self.pick_index.remove(piece)
+
     def _pick_cb (self, w):
+        if self.pick_index is not None and w in self.pick_index:
+            # Piece windows are plain rectangles, find the piece actually drawn there
+            wx,wy = self._piece_xy(w)
+            px,py = w.press_coords
+            target = self.pick_index.pick(wx+px, wy+py,
+                                          lambda p: p.get_sensitive() and p.get_parent() is self._container)
+            self._grabbed[w] = target
+            if target is None:
+                return
+            w = target
+        self.repaint_stats.reset()
+        # Nothing else moves the cluster or resizes the play area while dragging
+        self._drag_bounds = (w, self._cluster_bounds(w))
         self.emit('picked', w)
 
+    def _cluster_bounds (self, w):
+        """ Returns the (x0, y0, x1, y1) bounds of w and every piece joined to it,
+        relative to w, and the (width, height) of the play area. """
+        px,py = self._piece_xy(w)
+        x0, y0, x1, y1 = px, py, px, py
+        for p in self.board.get_cluster(w):
+            if p.get_parent() is not self._container:
+                continue
+            wx,wy = self._piece_xy(p)
+            wa = p.get_allocation()
+            x0, y0 = min(x0, wx), min(y0, wy)
+            x1, y1 = max(x1, wx+wa.width), max(y1, wy+wa.height)
+        ca = self._container.get_allocation()
+        return (x0-px, y0-py, x1-px, y1-py), (ca.width, ca.height)
+
+    def _grabbed_piece (self, w):
+        """ The piece a drag started on w's window applies to. """
+        return self._grabbed.get(w, w)
+
     def _move_cb (self, w, x, y, absolute=False):
-        if w.get_parent() != self._container:
+        if not absolute:
+            w = self._grabbed_piece(w)
+        if w is None or w.get_parent() != self._container:
             return
+        px,py = self._piece_xy(w)
         if absolute:
-            wx,wy = 0,0
-        else:
-            wx,wy = self._container.child_get(w, 'x', 'y')
+            # Turn it into a relative move, so pieces joined to w follow
+            x -= px
+            y -= py
 
-        wa = w.get_allocation()
-        ca = self._container.get_allocation()
-
-        w_width, w_height = wa.width, wa.height
-        c_width, c_height = ca.width, ca.height
-        if wx+x > 0 and wy+y > 0 and wx+w_width+x <= c_width \
-                and wy+w_height+y <= c_height:
+        if self._drag_bounds is not None and self._drag_bounds[0] is w:
+            (x0, y0, x1, y1), (c_width, c_height) = self._drag_bounds[1]
+        else:
+            (x0, y0, x1, y1), (c_width, c_height) = self._cluster_bounds(w)
+        x0, y0, x1, y1 = x0+px, y0+py, x1+px, y1+py
+        if x0+x > 0 and y0+y > 0 and x1+x <= c_width \
+                and y1+y <= c_height:
             #logging.debug("moving %i,%i : %i:%i : %i:%i" % (wx,wy, x, y,wx+x, wy+y))
-            self._container.move(w, max(0,wx+x), max(0,wy+y))
+            self.move_cluster(w, x, y)
 
     def _drop_cb (self, w, from_mesh=False):
-        if w.get_parent() != self._container:
+        if not from_mesh:
+            w = self._grabbed.pop(w, w)
+        if w is None or w.get_parent() != self._container:
             return
+        self._commit_drag()
+        self._drag_bounds = None
+        logging.debug("Drag repainted %i pixels per frame over %i frames" % (
+                self.repaint_stats.get_average(), self.repaint_stats.frames))
+        self.repaint_stats.reset()
         self.bring_to_top(w)
         alloc = w.get_allocation()
         x,y,a,b = alloc.x, alloc.y, alloc.width, alloc.height
@@ -744,28 +1658,17 @@ class JigsawPuzzleWidget (Gtk.EventBox):
             wx,wy,ww,wh = w.get_allocation().x, w.get_allocation().y, w.get_allocation().width, w.get_allocation().height
             bx,by,bw,bh = self.board.get_allocation().x, self.board.get_allocation().y, self.board.get_allocation().width, self.board.get_allocation().height
             self.board.drop_piece(w, wx-bx, wy-by)
+        if not w.placed:
+            snap = self.board.find_snap(w.get_index())
+            if snap is not None:
+                self.move_cluster(w, *snap)
+                self.board.join_aligned(w.get_index())
+                self.bring_to_top(w)
         self.emit('dropped', w, from_mesh)
         
     def _debug_cb (self, w, e, *args):
         logging.debug("%s %s %s" % (w, e, args))
 
-    def _freeze (self, img_cksum_only=False):
-        pieces = [(x.get_index(), None) for x in self.board.get_placed_pieces()]
-        
-        pieces.extend([(x.get_index(), x.get_position()) for x in self.get_floating_pieces()])
-        pieces.sort(key=lambda x: x[0])
-        return {'board': self.board._freeze(img_cksum_only),
-                'cutter': self.get_cutter(),
-                'target_pieces_per_line': self.get_target_pieces_per_line(),
-                'piece_pos': [x[1] for x in pieces]}
-
-    def _thaw (self, data):
-        if 'board' in data:
-            self.board._thaw(data['board'])
-        self.set_cutter(data.get('cutter', None))
-        self.set_target_pieces_per_line(data.get('target_pieces_per_line', None))
-        self.forced_location = data.get('piece_pos', None)
-        
 if __name__ == '__main__':
     w = Gtk.Window()
     j = JigsawPuzzleWidget()
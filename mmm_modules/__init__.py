@@ -1,6 +1,7 @@
 from .borderframe import *
 from .timer import *
 from .image_category import *
+from .image_catalog import *
 from .i18n import *
 from .buddy_panel import *
 from .tube_helper import *
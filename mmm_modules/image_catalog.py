@@ -0,0 +1,275 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# If you find this activity useful or end up using parts of it in one of your
+# own creations we would love to hear from you at info@WorldWideWorkshop.org !
+#
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib
+from gi.repository import Gio
+from gi.repository import GdkPixbuf
+
+import os
+import json
+import bisect
+import base64
+import logging
+import tempfile
+import threading
+
+# Only the classes are exported, mmm_modules star imports this module and must keep
+# its own json module rather than the standard one imported here
+__all__ = ['ImageCatalog', 'ImageIndex']
+
+CATALOG_VERSION = 1
+# Milliseconds to wait after a change before writing the catalog, so the changes
+# coming in the meantime are written along with it, see ImageCatalog.queue_save
+CATALOG_SAVE_DELAY = 2000
+
+class ImageCatalog (object):
+    """ A manifest of image directories, kept in one json file so they need not be
+    scanned and their thumbnails decoded every time they are listed.
+    Every directory entry records its image list and count, the image dimensions and
+    the category thumbnail as a base64 png, and is only trusted while the directory
+    modification time is the one it was recorded with.
+    Changes are written CATALOG_SAVE_DELAY after the first one not written yet,
+    or by flush. """
+    def __init__ (self, filename):
+        self.filename = filename
+        self.entries = None
+        self.dirty = False
+        self._thumbs = {}
+        self._save_id = None
+        self._lock = threading.Lock()
+
+    def _load (self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            if data.get('version') == CATALOG_VERSION:
+                self.entries = data['entries']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.debug("Image catalog %s not read: %s" % (self.filename, e))
+
+    def save (self):
+        """ Writes the catalog, falling back to the temporary directory if its own
+        directory can not be written to. """
+        if self.entries is None:
+            return False
+        data = json.dumps({'version': CATALOG_VERSION, 'entries': self.entries})
+        self.dirty = False
+        for filename in (self.filename, self._fallback_filename()):
+            try:
+                path = os.path.dirname(filename)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, filename)
+                self.filename = filename
+                return True
+            except (IOError, OSError) as e:
+                logging.error("Failed to write image catalog %s: %s" % (filename, e))
+        return False
+
+    def queue_save (self):
+        """ Marks the catalog changed, to be written in CATALOG_SAVE_DELAY along with
+        whatever else changes until then. Safe to call from any thread. """
+        self.dirty = True
+        if self._save_id is None:
+            self._save_id = GLib.timeout_add(CATALOG_SAVE_DELAY, self._save_cb)
+
+    def _save_cb (self):
+        self._save_id = None
+        self.flush()
+        return False
+
+    def flush (self):
+        """ Writes the catalog right away if it changed since it was last written. """
+        with self._lock:
+            if self.dirty:
+                self.save()
+
+    def _fallback_filename (self):
+        return os.path.join(tempfile.gettempdir(), 'mmm-%s' % os.path.basename(self.filename))
+
+    def _mtime (self, directory):
+        try:
+            return os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+    def lookup (self, directory):
+        """ The entry of directory, or None if there is none or it is out of date. """
+        with self._lock:
+            self._load()
+            entry = self.entries.get(directory)
+        if entry is None or entry['mtime'] != self._mtime(directory):
+            return None
+        return entry
+
+    def update (self, directory, images):
+        """ Records the image list of directory, its thumb is recorded later on by
+        set_thumb. The catalog is written along with the other directories scanned
+        meanwhile, see queue_save. Returns the new entry. """
+        sizes = []
+        for fn in images:
+            info = None
+            try:
+                info = GdkPixbuf.Pixbuf.get_file_info(fn)
+            except (GLib.Error, TypeError):
+                pass
+            if info is not None and info[0] is not None:
+                sizes.append((info[1], info[2]))
+            else:
+                sizes.append(None)
+        entry = {'mtime': self._mtime(directory),
+                 'images': list(images),
+                 'count': len(images),
+                 'sizes': sizes,
+                 'thumb': None}
+        with self._lock:
+            self._load()
+            self.entries[directory] = entry
+            self._thumbs.pop(directory, None)
+            self.queue_save()
+        return entry
+
+    def _set_thumb (self, directory, entry, thumb):
+        ok, data = thumb.save_to_bufferv('png', [], [])
+        if ok:
+            entry['thumb'] = base64.b64encode(data).decode('ascii')
+            self._thumbs[directory] = thumb
+
+    def set_thumb (self, directory, thumb):
+        """ Records the thumb pixbuf of directory, if its entry is up to date. """
+        entry = self.lookup(directory)
+        if entry is None:
+            return
+        with self._lock:
+            self._set_thumb(directory, entry, thumb)
+            self.queue_save()
+
+    def forget (self, directory):
+        """ Drops the entry of directory, as when one of its images changed in place,
+        which the directory modification time does not tell. """
+        with self._lock:
+            self._load()
+            if self.entries.pop(directory, None) is not None:
+                self._thumbs.pop(directory, None)
+                self.queue_save()
+
+    def get_thumb (self, directory, entry):
+        """ The thumb pixbuf recorded in the entry of directory, None if it has none. """
+        if entry['thumb'] is None:
+            return None
+        if directory not in self._thumbs:
+            loader = GdkPixbuf.PixbufLoader()
+            try:
+                loader.write(base64.b64decode(entry['thumb']))
+                loader.close()
+                self._thumbs[directory] = loader.get_pixbuf()
+            except (GLib.Error, ValueError) as e:
+                logging.debug("Bad thumb for %s in the image catalog: %s" % (directory, e))
+                self._thumbs[directory] = None
+        return self._thumbs[directory]
+
+
+class ImageIndex (object):
+    """ The image lists of directories, each listed once and then kept up to date by a
+    Gio.FileMonitor watching the directory. Images added or removed are inserted in
+    or dropped from the sorted list as they come and go; links (*.lnk) changing have
+    the whole directory listed again. The lists are shared with whoever asked for them,
+    so they always see the current content. """
+    def __init__ (self, catalog=None):
+        self.catalog = catalog
+        self.images = {}
+        self._scanners = {}
+        self._monitors = {}
+
+    def get_images (self, directory, scan):
+        """ The image list of directory, listed with scan(directory) the first time.
+        Directories that can not be watched are listed again every time. """
+        images = self.images.get(directory)
+        if images is None:
+            images = scan(directory)
+            try:
+                monitor = Gio.File.new_for_path(directory).monitor_directory(
+                    Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as e:
+                logging.debug("Not watching %s: %s" % (directory, e))
+                return images
+            monitor.connect('changed', self._changed_cb, directory)
+            self._monitors[directory] = monitor
+            self.images[directory] = images
+            self._scanners[directory] = scan
+        return images
+
+    def stop (self):
+        """ Stops watching every directory. """
+        for monitor in self._monitors.values():
+            monitor.cancel()
+        self._monitors = {}
+        self.images = {}
+        self._scanners = {}
+
+    def _add (self, images, path):
+        i = bisect.bisect_left(images, path)
+        if i == len(images) or images[i] != path:
+            images.insert(i, path)
+
+    def _remove (self, images, path):
+        i = bisect.bisect_left(images, path)
+        if i < len(images) and images[i] == path:
+            del images[i]
+
+    def _changed_cb (self, monitor, f, other, event, directory):
+        images = self.images.get(directory)
+        if images is None:
+            return
+        name = f.get_basename()
+        other_name = other is not None and other.get_basename() or ''
+        if name.endswith('.lnk') or other_name.endswith('.lnk'):
+            # Forgotten first, as with coarse modification times the scan could take
+            # the catalog entry for still up to date
+            if self.catalog is not None:
+                self.catalog.forget(directory)
+            images[:] = self._scanners[directory](directory)
+            logging.debug("Image directory %s listed again, %i images" % (directory, len(images)))
+            return
+        if event == Gio.FileMonitorEvent.RENAMED:
+            if not name.startswith('image_') and not other_name.startswith('image_'):
+                return
+            self._remove(images, os.path.join(directory, name))
+            if other_name.startswith('image_'):
+                self._add(images, os.path.join(directory, other_name))
+        elif not name.startswith('image_'):
+            return
+        elif event in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.MOVED_IN):
+            self._add(images, os.path.join(directory, name))
+        elif event in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+            self._remove(images, os.path.join(directory, name))
+        elif event != Gio.FileMonitorEvent.CHANGES_DONE_HINT:
+            return
+        logging.debug("Image directory %s changed, %i images" % (directory, len(images)))
+        if self.catalog is not None:
+            self.catalog.forget(directory)
@@ -22,17 +22,21 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 from gi.repository import GObject
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
 
 import os
 from glob import glob
 import logging
 import hashlib
+import threading
+from collections import OrderedDict
 
 from sugar3 import mime
 from sugar3.graphics.objectchooser import ObjectChooser
 
 from .borderframe import BorderFrame
-from .utils import load_image, resize_image, RESIZE_CUT
+from .utils import load_image, load_image_at_size, resize_image, RESIZE_CUT, RESIZE_PAD
 
 cwd = os.path.normpath(os.path.join(os.path.split(__file__)[0], '..'))
 
@@ -54,6 +58,19 @@ from gettext import gettext as _
 
 THUMB_SIZE = 48
 IMAGE_SIZE = 200
+# Pictures are shrunk to fit this size as they are decoded, as neither the selector nor
+# the board ever show them any bigger
+SOURCE_SIZE = 1200
+# An ImageCatalog to read image directories from instead of scanning them, None to always scan
+CATALOG = None
+# An ImageIndex keeping the image lists of watched directories, None to list them every time
+IMAGE_INDEX = None
+# Number of threads CategorySelector loads thumbnails with
+THUMB_WORKERS = 2
+# How many images on each side of the shown one ImageSelectorWidget decodes ahead of time
+PREFETCH_IMAGES = 2
+# How many decoded images each CategoryDirectory keeps, the shown one included
+IMAGE_CACHE_SIZE = 2*PREFETCH_IMAGES + 1
 #MYOWNPIC_FOLDER = os.path.expanduser("~/.sugar/default/org.worldwideworkshop.olpc.MyOwnPictures")
 
 def prepare_btn (btn):
@@ -62,11 +79,125 @@ def prepare_btn (btn):
 def register_category (pixbuf_class, path):
     pass
 
+def find_thumb (path):
+    """ The thumbnail file of the image directory path, None if it has none of its own. """
+    thumbs = glob(os.path.join(path, "thumb.*"))
+    thumbs.extend(glob(os.path.join(path, "default_thumb.*")))
+    thumbs = [x for x in thumbs if os.path.exists(x)]
+    if not thumbs:
+        return None
+    return thumbs[0]
+
+def scan_images (path):
+    """ Lists all images in path as per the wildcard expansion of 'image_*'.
+    Adds all linked images from files (*.lnk)
+    The list is read from CATALOG instead while the directory did not change. """
+    if CATALOG is not None:
+        entry = CATALOG.lookup(path)
+        if entry is not None:
+            return list(entry['images'])
+    images = []
+    links = glob(os.path.join(path, "*.lnk"))
+    for link in links:
+        fpath = file(link).readlines()[0].strip()
+        if os.path.isfile(fpath) and not (fpath in images):
+            images.append(fpath)
+        else:
+            os.remove(link)
+    images.extend(glob(os.path.join(path, "image_*")))
+    images.sort()
+    if CATALOG is not None:
+        # The thumb is recorded once it is loaded
+        CATALOG.update(path, images)
+    return images
+
+def list_images (path):
+    """ The images in path, from IMAGE_INDEX if it is set. The list is shared with the index,
+    which keeps it up to date. """
+    if IMAGE_INDEX is not None:
+        return IMAGE_INDEX.get_images(path, scan_images)
+    return scan_images(path)
+
+def load_thumb (filename):
+    """ Loads a THUMB_SIZE thumbnail with GdkPixbuf alone, so it can be called from any thread.
+    Returns None if filename can not be loaded this way. """
+    pb = load_image_at_size(filename, THUMB_SIZE, THUMB_SIZE)
+    if pb is None:
+        return None
+    return resize_image(pb, THUMB_SIZE, THUMB_SIZE)
+
+
+class ThumbLoader (object):
+    """ Loads thumbnails, or any pictures, on THUMB_WORKERS threads, handing each one to
+    deliver(key, pb) on the main loop as it is ready, and calling done() once all are.
+    load(key) does the loading. Keys still waiting can be moved to the front with
+    prioritize, and cancel drops whatever was not delivered yet. """
+    def __init__ (self, load, deliver, done=None, workers=THUMB_WORKERS):
+        self.load = load
+        self.deliver = deliver
+        self.done = done
+        self.workers = workers
+        self.pending = []
+        self.cancelled = False
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def start (self, keys):
+        self.pending = list(keys)
+        self._running = max(1, min(self.workers, len(self.pending)))
+        for i in range(self._running):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+
+    def prioritize (self, keys):
+        """ Loads keys, those still waiting, before any other. """
+        with self._lock:
+            keys = [k for k in keys if k in self.pending]
+            first = set(keys)
+            self.pending = keys + [k for k in self.pending if k not in first]
+
+    def cancel (self):
+        with self._lock:
+            self.cancelled = True
+            self.pending = []
+
+    def _run (self):
+        while True:
+            with self._lock:
+                if self.cancelled or not self.pending:
+                    self._running -= 1
+                    last = self._running == 0 and not self.cancelled
+                    break
+                key = self.pending.pop(0)
+            try:
+                pb = self.load(key)
+            except Exception as e:
+                logging.debug("Failed loading thumb %s: %s" % (key, e))
+                pb = None
+            GLib.idle_add(self._deliver, key, pb)
+        if last and self.done is not None:
+            GLib.idle_add(self._done)
+
+    def _deliver (self, key, pb):
+        if not self.cancelled:
+            self.deliver(key, pb)
+        return False
+
+    def _done (self):
+        if not self.cancelled:
+            self.done()
+        return False
+
 class CategoryDirectory (object):
     def __init__ (self, path, width=-1, height=-1, method=RESIZE_CUT):
         self.path = path
         self.method = method
         self.pb = None
+        # Where filename is in images, so stepping through them needs no search
+        self.pos = None
+        # Image name -> (modification time, decoded pixbuf, resized one), last used last
+        self.cache = OrderedDict()
         if os.path.isdir(path):
             self.gather_images()
         else:
@@ -77,22 +208,13 @@ class CategoryDirectory (object):
         self.name = os.path.basename(path)
 
     def gather_images (self):
-        """ Lists all images in the selected path as per the wildcard expansion of 'image_*'.
-        Adds all linked images from files (*.lnk) """
-        self.images = []
-        links = glob(os.path.join(self.path, "*.lnk"))
-        for link in links:
-            fpath = file(link).readlines()[0].strip()
-            if os.path.isfile(fpath) and not (fpath in self.images):
-                self.images.append(fpath)
-            else:
-                os.remove(link)
-        self.images.extend(glob(os.path.join(self.path, "image_*")))
-        self.images.sort()
+        """ Lists all images in the selected path, see list_images. """
+        self.images = list_images(self.path)
 
     def set_image_size (self, w, h):
         self.width = w
         self.height = h
+        self.cache = OrderedDict()
 
     def set_thumb_size (self, w, h):
         self.twidth = w
@@ -102,36 +224,96 @@ class CategoryDirectory (object):
     def get_image (self, name):
         if not len(self.images) or name is None or name not in self.images:
             return None
-        self.pb = load_image(name)
-        if self.pb is not None:
+        return self._get_image(name, None)
+
+    def _get_image (self, name, pos):
+        cached = self.get_cached(name)
+        if cached is not None:
+            self.pb, rv = cached
+        else:
+            self.pb = load_image(name, SOURCE_SIZE, SOURCE_SIZE, RESIZE_PAD, grow=False)
+            if self.pb is None:
+                return None
             rv = resize_image(self.pb, self.width, self.height, method=self.method)
-            self.filename = name
-            return rv
-        return None
-            
+            self.add_cached(name, self.pb, rv)
+        self.filename = name
+        self.pos = pos
+        return rv
+
+    def decode (self, name):
+        """ What get_image would load for name, as (pixbuf, resized pixbuf), using GdkPixbuf
+        alone so it can run on any thread. Returns None if name can not be loaded that way. """
+        pb = load_image_at_size(name, SOURCE_SIZE, SOURCE_SIZE, RESIZE_PAD)
+        if pb is None:
+            return None
+        return pb, resize_image(pb, self.width, self.height, method=self.method)
+
+    def _mtime (self, name):
+        try:
+            return os.stat(name).st_mtime
+        except OSError:
+            return None
+
+    def get_cached (self, name):
+        """ The (pixbuf, resized pixbuf) of name if it is cached and did not change since. """
+        entry = self.cache.get(name)
+        if entry is None or entry[0] != self._mtime(name):
+            return None
+        self.cache.move_to_end(name)
+        return entry[1:]
+
+    def add_cached (self, name, pb, resized):
+        self.cache[name] = (self._mtime(name), pb, resized)
+        self.cache.move_to_end(name)
+        while len(self.cache) > IMAGE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def get_neighbours (self, count):
+        """ The names of up to count images on each side of the current one, closest first. """
+        pos = self.get_pos()
+        n = len(self.images)
+        if pos is None or n < 2:
+            return []
+        rv = []
+        for d in range(1, count+1):
+            for name in (self.images[(pos+d) % n], self.images[(pos-d) % n]):
+                if name != self.filename and name not in rv:
+                    rv.append(name)
+        return rv
+
+    def get_pos (self):
+        """ Where filename is in images, None if it is not there. """
+        if self.filename is None:
+            return None
+        pos = self.pos
+        if pos is None or pos >= len(self.images) or self.images[pos] != self.filename:
+            # The list changed under us, or the image was not reached by stepping
+            if self.filename not in self.images:
+                return None
+            pos = self.pos = self.images.index(self.filename)
+        return pos
+
     def get_next_image (self):
         if not len(self.images):
             return None
-        if self.filename is None or self.filename not in self.images:
+        pos = self.get_pos()
+        if pos is None:
             pos = -1
-        else:
-            pos = self.images.index(self.filename)
         pos += 1
         if pos >= len(self.images):
             pos = 0
-        return self.get_image(self.images[pos])
+        return self._get_image(self.images[pos], pos)
 
     def get_previous_image (self):
         if not len(self.images):
             return None
-        if self.filename is None or self.filename not in self.images:
+        pos = self.get_pos()
+        if pos is None:
             pos = len(self.images)
-        else:
-            pos = self.images.index(self.filename)
         pos -= 1
         if pos < 0:
             pos = len(self.images) - 1
-        return self.get_image(self.images[pos])
+        return self._get_image(self.images[pos], pos)
 
     def has_images (self):
         logging.debug("IMG %s" % self.images)
@@ -143,8 +325,28 @@ class CategoryDirectory (object):
     def has_image (self):
         return self.pb is not None
 
+    def get_own_thumb (self):
+        """ The THUMB_SIZE thumbnail of the directory itself, None if it has none. """
+        if CATALOG is not None:
+            entry = CATALOG.lookup(self.path)
+            if entry is not None:
+                pb = CATALOG.get_thumb(self.path, entry)
+                if pb is not None:
+                    return pb
+        thumb = find_thumb(self.path)
+        if thumb is None:
+            return None
+        pb = load_image(thumb, THUMB_SIZE, THUMB_SIZE)
+        if pb is not None and CATALOG is not None:
+            CATALOG.set_thumb(self.path, pb)
+        return pb
+
     def _get_category_thumb (self):
         if os.path.isdir(self.path):
+            if (self.twidth, self.theight) == (THUMB_SIZE, THUMB_SIZE):
+                pb = self.get_own_thumb()
+                if pb is not None:
+                    return pb
             thumbs = glob(os.path.join(self.path, "thumb.*"))
             thumbs.extend(glob(os.path.join(self.path, "default_thumb.*")))
             thumbs.extend(glob(os.path.join(mmmpath, "mmm_images","default_thumb.*")))
@@ -207,6 +409,8 @@ class ImageSelectorWidget (Gtk.Table):
         self.attach(prepare_btn_cb(self.br), 3,4,1,2,0,0)
         self.attach(Gtk.Label(),4,5,1,2)
         self.filename = None
+        self.prefetcher = None
+        self.connect('destroy', self._destroy_cb)
         self.show_all()
         self.image.set_size_request(width, height)
         if image_dir is None:
@@ -330,11 +534,34 @@ class ImageSelectorWidget (Gtk.Table):
         pb = self.category.get_next_image()
         if pb is not None:
             self.image.set_from_pixbuf(pb)
+            self.prefetch()
 
     def previous (self, *args, **kwargs):
         pb = self.category.get_previous_image()
         if pb is not None:
             self.image.set_from_pixbuf(pb)
+            self.prefetch()
+
+    def prefetch (self):
+        """ Decodes the images around the shown one in the background, so stepping to them
+        only has to show them. """
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        category = self.category
+        names = [n for n in category.get_neighbours(PREFETCH_IMAGES)
+                 if category.get_cached(n) is None]
+        if not names:
+            return
+        def deliver (name, loaded):
+            if loaded is not None:
+                category.add_cached(name, *loaded)
+        self.prefetcher = ThumbLoader(category.decode, deliver, workers=1)
+        self.prefetcher.start(names)
+
+    def _destroy_cb (self, *args):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
 
     def get_image_dir (self):
         return self.category.path
@@ -351,6 +578,7 @@ class ImageSelectorWidget (Gtk.Table):
         self.cat_thumb.set_from_pixbuf(self.category.thumb)
         if filename:
             self.image.set_from_pixbuf(self.category.get_image(filename))
+            self.prefetch()
         else:
             if self.category.has_images():
                 self.next()
@@ -391,8 +619,11 @@ class ImageSelectorWidget (Gtk.Table):
         """ retrieves a frozen status from a python object, as per _freeze """
         self.set_image_dir(obj.get('image_dir', None))
         self.image.set_from_pixbuf(self.category.get_image(obj.get('filename', None)))
+        self.prefetch()
 
 class CategorySelector (Gtk.ScrolledWindow):
+    """ Lists the image categories under path. The list shows right away, with blank
+    thumbnails that are filled in as a ThumbLoader loads them, visible rows first. """
     __gsignals__ = {'selected' : (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (str,))}
     
     def __init__ (self, title=None, selected_category_path=None, path=None, extra=()):
@@ -402,6 +633,14 @@ class CategorySelector (Gtk.ScrolledWindow):
             path = os.path.join(mmmpath, 'mmm_images')
         self.path = path
         self.thumbs = []
+        # The category path and row of each thumb
+        self.thumb_paths = []
+        self.thumb_rows = []
+        self.placeholder = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                                THUMB_SIZE, THUMB_SIZE)
+        self.placeholder.fill(0)
+        default_thumbs = glob(os.path.join(self.path, "default_thumb.*"))
+        self.default_thumb = default_thumbs and default_thumbs[0] or None
         model, selected = self.get_model(path, selected_category_path, extra)
         self.ignore_first = selected is not None
         
@@ -422,6 +661,12 @@ class CategorySelector (Gtk.ScrolledWindow):
             self.treeview.get_selection().select_path(selected)
         self.treeview.connect("cursor-changed", self.do_select)
 
+        self.loader = ThumbLoader(self._load_thumb, self._thumb_cb, self._thumbs_done)
+        self.loader.start(self._get_load_order(model, selected))
+        self.treeview.connect('map', self._prioritize_visible)
+        self.get_vadjustment().connect('value-changed', self._prioritize_visible)
+        self.connect('destroy', self._destroy_cb)
+
     def grab_focus (self):
         self.treeview.grab_focus()
 
@@ -444,10 +689,13 @@ class CategorySelector (Gtk.ScrolledWindow):
         files = [os.path.join(path, x) for x in os.listdir(path) if not x.startswith('.')]
         files.extend(extra)
         for fullpath, prettyname in [(x, _(os.path.basename(x))) for x in files if os.path.isdir(x)]:
-            count = CategoryDirectory(fullpath).count_images()
+            count = len(list_images(fullpath))
             logging.debug("%s %s %s" % (fullpath, prettyname, count))
-            store.append([fullpath, prettyname + (" (%i)" % count), len(self.thumbs)])
-            self.thumbs.append(self.get_pb(fullpath))
+            it = store.append([fullpath, prettyname + (" (%i)" % count), len(self.thumbs)])
+            # Loaded later on, see _load_thumb
+            self.thumbs.append(self.placeholder)
+            self.thumb_paths.append(fullpath)
+            self.thumb_rows.append(Gtk.TreeRowReference.new(store, store.get_path(it)))
         #if os.path.isdir(MYOWNPIC_FOLDER):
         #    count = CategoryDirectory(MYOWNPIC_FOLDER).count_images()
         #    store.append([MYOWNPIC_FOLDER, _("My Pictures") + (" (%i)" % count), len(self.thumbs)])
@@ -461,6 +709,70 @@ class CategorySelector (Gtk.ScrolledWindow):
             i = store.iter_next(i)
         return store, selected
 
+    def _get_load_order (self, model, selected):
+        """ The thumbs in the order they are listed, from the selected one on. """
+        keys = []
+        i = model.get_iter_first()
+        while i:
+            keys.append(model.get_value(i, 2))
+            i = model.iter_next(i)
+        if selected is not None:
+            first = selected.get_indices()[0]
+            keys = keys[first:] + keys[:first]
+        return keys
+
+    def _prioritize_visible (self, *args):
+        visible = self.treeview.get_visible_range()
+        if not visible or not visible[0]:
+            return
+        start, end = visible[-2:]
+        model = self.treeview.get_model()
+        keys = []
+        i = model.get_iter(start)
+        while i:
+            keys.append(model.get_value(i, 2))
+            if model.get_path(i).compare(end) >= 0:
+                break
+            i = model.iter_next(i)
+        self.loader.prioritize(keys)
+
+    def _load_thumb (self, key):
+        """ Runs on the loader threads. Returns the thumb pixbuf, None if it has to be
+        loaded by get_pb instead, and whether it is the category own thumb. """
+        path = self.thumb_paths[key]
+        if CATALOG is not None:
+            entry = CATALOG.lookup(path)
+            if entry is not None:
+                pb = CATALOG.get_thumb(path, entry)
+                if pb is not None:
+                    return pb, False
+        thumb = find_thumb(path)
+        if thumb is not None:
+            return load_thumb(thumb), True
+        if self.default_thumb is not None:
+            return load_thumb(self.default_thumb), False
+        return None, False
+
+    def _thumb_cb (self, key, loaded):
+        pb, own = loaded or (None, False)
+        path = self.thumb_paths[key]
+        if pb is None:
+            pb = self.get_pb(path)
+        elif own and CATALOG is not None:
+            CATALOG.set_thumb(path, pb)
+        self.thumbs[key] = pb
+        row = self.thumb_rows[key]
+        if row.valid():
+            model = row.get_model()
+            model.row_changed(row.get_path(), model.get_iter(row.get_path()))
+
+    def _thumbs_done (self):
+        if CATALOG is not None:
+            CATALOG.flush()
+
+    def _destroy_cb (self, *args):
+        self.loader.cancel()
+
     def do_select (self, tree, *args, **kwargs):
         if self.ignore_first:
             self.ignore_first = False
@@ -23,7 +23,13 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 from gi.repository import GdkPixbuf
 from gi.repository import Gdk
+from gi.repository import GLib
+import os
 import logging
+import math
+import threading
+import weakref
+from collections import OrderedDict
 logger = logging.getLogger('sliderpuzzle-activity-1')
 
 RESIZE_STRETCH = 1
@@ -32,9 +38,74 @@ RESIZE_PAD = 3
 
 TYPE_REG = []
 
+# Keep a pyramid of downscales for every pixbuf that gets resized, see get_pyramid
+USE_PYRAMIDS = True
+# Decode images straight at the size they are requested at, see decode_size
+DECODE_AT_SIZE = True
+# A PixbufCache load_image keeps what it loads in, None to load every time
+PIXBUF_CACHE = None
+# Default size budget of a PixbufCache
+PIXBUF_CACHE_SIZE = 16*1024*1024
+
 def register_image_type (handler):
     TYPE_REG.append(handler)
 
+class PixbufCache (object):
+    """ A process wide cache of loaded pixbufs, keyed by file, modification time and the
+    size and method they were loaded with, so a changed file is loaded again.
+    Pixbufs are accounted for by their pixel buffer size, rowstride*height, and the least
+    recently used ones are dropped once they add up to more than max_bytes.
+    Cached pixbufs are shared by every caller, which must not change them. """
+    def __init__ (self, max_bytes=PIXBUF_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+
+    def key (self, filename, *args):
+        """ The key for filename loaded with args, None if it can not be cached. """
+        try:
+            return (filename, os.stat(filename).st_mtime) + args
+        except (OSError, TypeError):
+            return None
+
+    def get (self, key):
+        with self._lock:
+            pb = self.entries.get(key)
+            if pb is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return pb
+
+    def put (self, key, pb):
+        size = pb.get_rowstride() * pb.get_height()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.get_rowstride() * old.get_height()
+            self.entries[key] = pb
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                key, old = self.entries.popitem(last=False)
+                self.bytes -= old.get_rowstride() * old.get_height()
+                self.evictions += 1
+
+    def clear (self):
+        with self._lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+
+    def get_stats (self):
+        """ Returns a dict with the hit, miss and eviction counts and the cache size. """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes}
+
 def calculate_relative_size (orig_width, orig_height, width, height):
     """ If any of width or height is -1, the returned width or height will be in the same relative scale as the
     given part.
@@ -64,7 +135,7 @@ def calculate_relative_size (orig_width, orig_height, width, height):
             out_h = height
     return out_w, out_h
 
-def load_image (filename, width=-1, height=-1, method=RESIZE_CUT):
+def load_image (filename, width=-1, height=-1, method=RESIZE_CUT, grow=True):
     """ load an image from filename, returning it's Gdk.PixBuf().
     If any or all of width and height are given, scale the loaded image to fit the given size(s).
     If both width and height and requested scaling can be achieved in two flavours, as defined by
@@ -78,11 +149,30 @@ def load_image (filename, width=-1, height=-1, method=RESIZE_CUT):
       - RESIZE_CUT: scale to 200x200, cut 50 off each top and bottom to fit 200x100
       - RESIZE STRETCH : scale to 200x100, by changing the image WxH ratio from 1:1 to 2:1, thus distorting it.
       - RESIZE_PAD: scale to 100x100, add 50 pixel padding for top and bottom to fit 200x100
+
+    If grow is False, images already small enough are returned as they are instead of scaled up.
+    Unless DECODE_AT_SIZE is off, images are decoded straight at the size they are needed at.
+    With PIXBUF_CACHE set, the same file loaded the same way is only loaded once.
     """
     for ht in TYPE_REG:
         if ht.can_handle(filename):
             return ht(width, height, filename)
 
+    cache = PIXBUF_CACHE
+    if cache is None:
+        return _load_image(filename, width, height, method, grow)
+    key = cache.key(filename, width, height, method, grow)
+    if key is None:
+        return _load_image(filename, width, height, method, grow)
+    pb = cache.get(key)
+    if pb is None:
+        pb = _load_image(filename, width, height, method, grow)
+        if pb is not None:
+            cache.put(key, pb)
+    return pb
+
+def _load_image (filename, width=-1, height=-1, method=RESIZE_CUT, grow=True):
+    """ load_image, without the type handlers and PIXBUF_CACHE. """
     logger.debug('be that')
 #    if filename.lower().endswith('.sequence'):
 #        slider = None
@@ -97,13 +187,121 @@ def load_image (filename, width=-1, height=-1, method=RESIZE_CUT):
 #            slider.prepare_stringed(2,2)
 #        return slider
 #
-    img = Gtk.Image()
+    pb = None
+    if DECODE_AT_SIZE and (width >= 0 or height >= 0):
+        pb = load_image_at_size(filename, width, height, method)
+    if pb is None:
+        img = Gtk.Image()
+        try:
+            img.set_from_file(filename)
+            pb = img.get_pixbuf()
+        except:
+            return None
+    if pb is not None and not grow and \
+            decode_size(pb.get_width(), pb.get_height(), width, height, method) is None:
+        return pb
+    return resize_image(pb, width, height, method)
+
+def decode_size (orig_width, orig_height, width=-1, height=-1, method=RESIZE_CUT):
+    """ The smallest size an orig_width x orig_height image can be decoded at and still
+    be resized to width x height as resize_image would, or None if that is the full size.
+    >>> decode_size(4000, 3000, 200, 200, RESIZE_CUT)
+    (267, 200)
+    >>> decode_size(4000, 3000, 200, 200, RESIZE_PAD)
+    (200, 150)
+    >>> decode_size(4000, 3000, 200, 100, RESIZE_STRETCH)
+    (200, 100)
+    >>> decode_size(100, 100, 200, 200, RESIZE_CUT)
+    """
+    if method == RESIZE_STRETCH or width < 0 or height < 0:
+        w, h = calculate_relative_size(orig_width, orig_height, width, height)
+        if w >= orig_width and h >= orig_height:
+            return None
+        return min(w, orig_width), min(h, orig_height)
+    if method == RESIZE_PAD:
+        factor = min(float(width)/orig_width, float(height)/orig_height)
+    else:
+        factor = max(float(width)/orig_width, float(height)/orig_height)
+    if factor >= 1:
+        return None
+    # Round up, the image must not end up smaller than what is cut or padded from it
+    return (max(1, int(math.ceil(orig_width * factor))),
+            max(1, int(math.ceil(orig_height * factor))))
+
+def load_image_at_size (filename, width=-1, height=-1, method=RESIZE_CUT):
+    """ Decodes filename directly at the size given by decode_size, without ever holding
+    the full size image. Returns None if the file can not be read this way. """
     try:
-        img.set_from_file(filename)
-        pb = img.get_pixbuf()
-    except:
+        info = GdkPixbuf.Pixbuf.get_file_info(filename)
+        if info is None or info[0] is None:
+            return None
+        size = decode_size(info[1], info[2], width, height, method)
+        if size is None:
+            return GdkPixbuf.Pixbuf.new_from_file(filename)
+        return GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, size[0], size[1],
+                                                       method != RESIZE_STRETCH)
+    except (GLib.Error, TypeError):
         return None
-    return resize_image(pb, width, height, method)
+
+class ImagePyramid (object):
+    """ The power of two downscales of a decoded image, built as they are needed.
+    Any size is scaled from the nearest level at least as big, so an image is only ever
+    scaled down from full size once. The last size asked for is kept as well, as the
+    same picture tends to be requested at the same size over and over.
+    The image itself is passed in on every call rather than kept, so the pyramid does
+    not keep it alive, see get_pyramid. """
+    def __init__ (self):
+        self.levels = []
+        self.last = None
+        self._lock = threading.Lock()
+
+    def get_level (self, pb, width, height):
+        """ The smallest of pb and its levels at least width x height, halving the
+        smallest level as needed. """
+        with self._lock:
+            while True:
+                level = self.levels and self.levels[-1] or pb
+                w, h = level.get_width() // 2, level.get_height() // 2
+                if w < max(1, width) or h < max(1, height):
+                    break
+                self.levels.append(level.scale_simple(w, h, GdkPixbuf.InterpType.BILINEAR))
+            for level in reversed(self.levels):
+                if level.get_width() >= width and level.get_height() >= height:
+                    return level
+            return pb
+
+    def scale (self, pb, width, height):
+        """ pb scaled to exactly width x height. """
+        if pb.get_width() == width and pb.get_height() == height:
+            return pb
+        last = self.last
+        if last is not None and last[0] == (width, height):
+            return last[1]
+        level = self.get_level(pb, width, height)
+        if level.get_width() == width and level.get_height() == height:
+            rv = level
+        else:
+            rv = level.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+        self.last = ((width, height), rv)
+        return rv
+
+_pyramids = weakref.WeakKeyDictionary()
+_pyramids_lock = threading.Lock()
+
+def get_pyramid (pb):
+    """ The pyramid of pb, made on first use and dropped along with pb. """
+    with _pyramids_lock:
+        pyramid = _pyramids.get(pb)
+        if pyramid is None:
+            pyramid = _pyramids[pb] = ImagePyramid()
+        return pyramid
+
+def scale_pixbuf (pb, width, height):
+    """ pb scaled to width x height, through its pyramid if USE_PYRAMIDS is set. """
+    width, height = max(1, int(width)), max(1, int(height))
+    if not USE_PYRAMIDS:
+        return pb.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+    return get_pyramid(pb).scale(pb, width, height)
 
 def resize_image(pb, width=-1, height=-1, method=RESIZE_CUT):
     if pb is None:
@@ -112,7 +310,7 @@ def resize_image(pb, width=-1, height=-1, method=RESIZE_CUT):
     if method == RESIZE_STRETCH or width == -1 or height == -1:
         w,h = calculate_relative_size(
             pb.get_width(), pb.get_height(), width, height)
-        scaled_pb = pb.scale_simple(w, h, GdkPixbuf.InterpType.BILINEAR)
+        scaled_pb = scale_pixbuf(pb, w, h)
     elif method == RESIZE_PAD:
         w,h = pb.get_width(), pb.get_height()
         hr = float(height)/h
@@ -121,8 +319,7 @@ def resize_image(pb, width=-1, height=-1, method=RESIZE_CUT):
         w = w * factor
         h = h * factor
         logging.debug("RESIZE_PAD: %i,%i,%f" % (w,h,factor))
-        scaled_pb = pb.scale_simple(
-            int(w), int(h), GdkPixbuf.InterpType.BILINEAR)
+        scaled_pb = scale_pixbuf(pb, w, h)
     else:  # RESIZE_CUT / default
         w,h = pb.get_width(), pb.get_height()
         if width > w:
@@ -158,7 +355,7 @@ def resize_image(pb, width=-1, height=-1, method=RESIZE_CUT):
         # w, h now have -1 for the side that should be relatively scaled, to keep the aspect ratio and
         # assuring that the image is at least as big as the request.
         w,h = calculate_relative_size(pb.get_width(), pb.get_height(), w,h)
-        scaled_pb = pb.scale_simple(w,h, GdkPixbuf.InterpType.BILINEAR)
+        scaled_pb = scale_pixbuf(pb, w, h)
         # now we cut whatever is left to make the requested size
         scaled_pb = scaled_pb.new_subpixbuf(
             abs((width-w)/2), abs((height-h)/2), width, height)